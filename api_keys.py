@@ -0,0 +1,98 @@
+import hashlib
+import json
+import math
+import time
+
+from fastapi import HTTPException
+
+from constants import API_KEYS, API_KEYS_FILE
+from logging_config import get_logger
+
+logger = get_logger()
+
+PRIORITIES = {"interactive": 0, "standard": 1, "batch": 2}
+
+
+class ApiKey:
+    """An API key with its priority class, concurrency quota and audio-seconds token bucket.
+
+    `rate` is the number of audio seconds per second added to the bucket, up to
+    `burst`. A request is admitted while the bucket is not empty and its audio
+    duration is then withdrawn, possibly leaving the bucket in debt.
+    `max_pending` bounds the transcriptions of the key queued or running at
+    once. A `rate`, `max_concurrency` or `max_pending` of 0 means unlimited.
+
+    `owner` identifies the key where it is stored, such as in the jobs database,
+    without storing the key itself.
+    """
+
+    __slots__ = ("key", "owner", "name", "priority", "max_concurrency", "max_pending", "rate", "burst", "tokens", "updated")
+
+    def __init__(self, key: str, name: str = None, priority: str = "standard", max_concurrency: int = 0, max_pending: int = 0, rate: float = 0, burst: float = None):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Invalid priority {priority} for API key {name or key[:4]}, expected one of {', '.join(PRIORITIES)}.")
+        self.key = key
+        self.owner = hashlib.sha256(key.encode()).hexdigest()
+        self.name = name or key[:4] + "..."
+        self.priority = PRIORITIES[priority]
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * 60
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def check_rate(self):
+        if self.rate <= 0:
+            return
+        self._refill()
+        if self.tokens <= 0:
+            logger.warning(f"API key {self.name} exceeded its rate limit.")
+            raise HTTPException(
+                status_code=429,
+                detail={
+                    "error": {
+                        "message": "Rate limit exceeded for this API key. Please retry later.",
+                        "type": "rate_limit_error",
+                        "param": "",
+                        "code": 429
+                    }
+                },
+                headers={"Retry-After": str(max(1, math.ceil(-self.tokens / self.rate)))},
+            )
+
+    def consume(self, audio_seconds: float):
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= audio_seconds
+
+    def stats(self) -> dict:
+        if self.rate > 0:
+            self._refill()
+        return {
+            "priority": next(name for name, value in PRIORITIES.items() if value == self.priority),
+            "max_concurrency": self.max_concurrency,
+            "max_pending": self.max_pending,
+            "rate": self.rate,
+            "tokens": round(self.tokens, 3) if self.rate > 0 else None,
+        }
+
+
+def load_api_keys() -> dict:
+    if API_KEYS_FILE:
+        with open(API_KEYS_FILE) as file:
+            config = json.load(file)
+    elif API_KEYS:
+        config = json.loads(API_KEYS)
+    else:
+        config = {"dummy_api_key": {}}  # replace with your API keys through API_KEYS or API_KEYS_FILE
+    return {key: ApiKey(key, **options) for key, options in config.items()}
+
+
+api_keys = load_api_keys()
+api_keys_by_owner = {api_key.owner: api_key for api_key in api_keys.values()}
@@ -0,0 +1,237 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from faster_whisper.audio import decode_audio, pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import (
+    BatchedInferencePipeline,
+    Segment,
+    TranscriptionInfo,
+    TranscriptionOptions,
+    Word,
+    get_suppressed_tokens,
+    restore_speech_timestamps,
+)
+from faster_whisper.vad import VadOptions, collect_chunks, get_speech_timestamps
+
+from constants import BATCH_WINDOW_MS, BATCH_MAX_SIZE, BATCH_WORKERS
+from logging_config import get_logger
+from metrics import BATCH_SIZE, BATCH_QUEUE_WAIT
+from model_registry import registry
+
+logger = get_logger()
+
+
+class _Chunk:
+    __slots__ = ("features", "metadata", "options", "future", "enqueued")
+
+    def __init__(self, features, metadata, options):
+        self.features = features
+        self.metadata = metadata
+        self.options = options
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class BatchingEngine:
+    """Batches VAD-split chunks from concurrent requests into shared decode calls.
+
+    Chunks are grouped by (model, language, initial_prompt, word_timestamps). A
+    group is dispatched once it holds `max_batch_size` chunks or its oldest chunk
+    has waited `window_ms`; results are scattered back to the originating requests.
+    """
+
+    def __init__(self, window_ms: int = BATCH_WINDOW_MS, max_batch_size: int = BATCH_MAX_SIZE, workers: int = BATCH_WORKERS):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.workers = workers
+        self._queues = {}
+        self._condition = threading.Condition()
+        self._executor = None
+        self._dispatcher = None
+        self._closed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def start(self):
+        if not self.enabled or self._dispatcher is not None:
+            return
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch")
+        self._dispatcher = threading.Thread(target=self._dispatch, name="batch-dispatcher", daemon=True)
+        self._dispatcher.start()
+        logger.info(f"Batching engine started with a {self.window * 1000:.0f} ms window and batches of up to {self.max_batch_size} chunks.")
+
+    def shutdown(self):
+        with self._condition:
+            self._closed = True
+            pending = [chunk for queue in self._queues.values() for chunk in queue]
+            self._queues.clear()
+            self._condition.notify_all()
+        for chunk in pending:
+            chunk.future.set_exception(RuntimeError("The batching engine was shut down."))
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+            self._dispatcher = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def can_batch(self, duration: float, vad_filter: bool) -> bool:
+        # Without VAD the batched pipeline can only cut inputs shorter than one window
+        return self._dispatcher is not None and (vad_filter or duration < 30)
+
+    def transcribe(self, model_name: str, audio, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+        with registry.acquire(model_name) as model:
+            sampling_rate = model.feature_extractor.sampling_rate
+            chunk_length = model.feature_extractor.chunk_length
+            if not isinstance(audio, np.ndarray):
+                audio = decode_audio(audio, sampling_rate=sampling_rate)
+            duration = audio.shape[0] / sampling_rate
+
+            vad_options = None
+            if vad_filter:
+                vad_options = VadOptions(min_silence_duration_ms=min_silence_duration_ms, max_speech_duration_s=chunk_length)
+                clip_timestamps = get_speech_timestamps(audio, vad_options)
+            else:
+                clip_timestamps = [{"start": 0, "end": audio.shape[0]}]
+            audio_chunks, chunks_metadata = collect_chunks(audio, clip_timestamps, max_duration=chunk_length)
+            duration_after_vad = sum(clip["end"] - clip["start"] for clip in clip_timestamps) / sampling_rate
+            features = [model.feature_extractor(chunk)[..., :-1] for chunk in audio_chunks] if duration_after_vad else []
+
+            all_language_probs = None
+            if language is None:
+                if not model.model.is_multilingual or not features:
+                    language, language_probability = "en", 1
+                else:
+                    language, language_probability, all_language_probs = model.detect_language(
+                        features=np.concatenate(features, axis=1)
+                    )
+            else:
+                language_probability = 1
+
+            tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=language)
+            options = TranscriptionOptions(
+                beam_size=5,
+                best_of=5,
+                patience=1,
+                length_penalty=1,
+                repetition_penalty=1,
+                no_repeat_ngram_size=0,
+                log_prob_threshold=-1.0,
+                no_speech_threshold=0.6,
+                compression_ratio_threshold=2.4,
+                condition_on_previous_text=False,
+                prompt_reset_on_temperature=0.5,
+                # The batched pipeline only decodes at the first temperature, without fallback
+                temperatures=[0.0],
+                initial_prompt=initial_prompt,
+                prefix=None,
+                suppress_blank=True,
+                suppress_tokens=get_suppressed_tokens(tokenizer, [-1]),
+                without_timestamps=True,
+                max_initial_timestamp=0.0,
+                word_timestamps=word_timestamps,
+                prepend_punctuations="\"'“¿([{-",
+                append_punctuations="\"'.。,，!！?？:：”)]}、",
+                multilingual=False,
+                max_new_tokens=None,
+                clip_timestamps=clip_timestamps,
+                hallucination_silence_threshold=None,
+                hotwords=None,
+            )
+
+        key = (model_name, language, initial_prompt, word_timestamps)
+        chunks = [self._submit(key, pad_or_trim(feature), metadata, options) for feature, metadata in zip(features, chunks_metadata)]
+
+        segments, segment_id = [], 0
+        for chunk in chunks:
+            for output in chunk.future.result():
+                segment_id += 1
+                segments.append(Segment(
+                    id=segment_id,
+                    seek=output["seek"],
+                    start=round(output["start"], 3),
+                    end=round(output["end"], 3),
+                    text=output["text"],
+                    tokens=output["tokens"],
+                    avg_logprob=output["avg_logprob"],
+                    compression_ratio=output["compression_ratio"],
+                    no_speech_prob=output["no_speech_prob"],
+                    words=[Word(**word) for word in output["words"]] if word_timestamps else None,
+                    temperature=0.0,
+                ))
+        info = TranscriptionInfo(
+            language=language,
+            language_probability=language_probability,
+            duration=duration,
+            duration_after_vad=duration_after_vad,
+            all_language_probs=all_language_probs,
+            transcription_options=options,
+            vad_options=vad_options,
+        )
+        return restore_speech_timestamps(segments, clip_timestamps, sampling_rate), info
+
+    def _submit(self, key, features, metadata, options) -> _Chunk:
+        chunk = _Chunk(features, metadata, options)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The batching engine is not running.")
+            self._queues.setdefault(key, []).append(chunk)
+            self._condition.notify_all()
+        return chunk
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._queues and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                # Serve the group whose oldest chunk has waited the longest
+                key = min(self._queues, key=lambda k: self._queues[k][0].enqueued)
+                deadline = self._queues[key][0].enqueued + self.window
+                while not self._closed and len(self._queues.get(key, ())) < self.max_batch_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+                queue = self._queues[key]
+                batch = queue[:self.max_batch_size]
+                del queue[:self.max_batch_size]
+                if not queue:
+                    del self._queues[key]
+            now = time.perf_counter()
+            BATCH_SIZE.observe(len(batch))
+            for chunk in batch:
+                BATCH_QUEUE_WAIT.observe(now - chunk.enqueued)
+            self._executor.submit(self._run_batch, key, batch)
+
+    def _run_batch(self, key, batch):
+        model_name, language = key[0], key[1]
+        try:
+            with registry.acquire(model_name) as model:
+                tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=language)
+                pipeline = BatchedInferencePipeline(model)
+                outputs = pipeline.forward(
+                    np.stack([chunk.features for chunk in batch]),
+                    tokenizer,
+                    [chunk.metadata for chunk in batch],
+                    batch[0].options,
+                )
+        except Exception as e:
+            logger.error(f"Batched decode of {len(batch)} chunk(s) failed: {str(e)}")
+            for chunk in batch:
+                chunk.future.set_exception(e)
+            return
+        for chunk, output in zip(batch, outputs):
+            chunk.future.set_result(output)
+
+
+batching_engine = BatchingEngine()
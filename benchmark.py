@@ -0,0 +1,383 @@
+"""Load-testing and benchmark harness for FastWhisperAPI.
+
+Generates synthetic audio locally and sends transcription requests to the app
+either in-process or over HTTP at the requested concurrency levels, or measures the
+encoding of a synthetic result in every response format. The report is written
+as JSON so two runs can be compared with `--compare`.
+
+    python benchmark.py --mode inprocess --models tiny,base --durations 5,30 --concurrency 1,4
+    python benchmark.py --mode http --url http://localhost:8000 --output run.json --compare baseline.json
+    python benchmark.py --mode serialization --segments 2000 --words-per-segment 20
+"""
+import argparse
+import io
+import itertools
+import json
+import math
+import platform
+import re
+import resource
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SAMPLING_RATE = 16000
+SIGNALS = ("speech", "tone", "noise")
+OPTION_SETS = {
+    "default": {},
+    "vad": {"vad_filter": True},
+    "words": {"timestamp_granularities": "word"},
+}
+# Metrics compared by --compare, and whether higher values are better
+COMPARED_METRICS = {
+    "throughput_rps": True, "latency_p50_s": False, "latency_p95_s": False, "latency_p99_s": False, "rtf_mean": False,
+    "serialize_s": False, "payload_bytes": False,
+}
+
+
+def generate_audio(signal: str, duration: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * SAMPLING_RATE)) / SAMPLING_RATE
+    if signal == "tone":
+        audio = 0.3 * np.sin(2 * np.pi * 440 * t)
+    elif signal == "noise":
+        audio = 0.1 * rng.standard_normal(t.shape[0])
+    elif signal == "speech":
+        # Voiced syllables: a gliding pitch with formant-like harmonics, shaped by a
+        # 4 Hz syllable envelope and separated by pauses of varying length
+        pitch = 120 + 30 * np.sin(2 * np.pi * 0.5 * t + rng.uniform(0, np.pi))
+        phase = 2 * np.pi * np.cumsum(pitch) / SAMPLING_RATE
+        audio = sum(np.sin(k * phase) / k * (1 + np.cos(2 * np.pi * k * 120 / 900)) for k in range(1, 12))
+        audio *= np.clip(np.sin(2 * np.pi * 4 * t), 0, None) ** 2
+        pauses = np.repeat(rng.random(int(math.ceil(duration))) < 0.25, SAMPLING_RATE)[:t.shape[0]]
+        audio[pauses] = 0
+        audio = 0.3 * audio / max(1e-9, np.abs(audio).max()) + 0.003 * rng.standard_normal(t.shape[0])
+    else:
+        raise ValueError(f"Unknown signal {signal}.")
+    return audio.astype(np.float32)
+
+
+def to_wav(audio: np.ndarray, seed: int) -> bytes:
+    # Requests get slightly different audio so the result cache does not serve them
+    audio = audio + 1e-4 * np.random.default_rng(seed).standard_normal(audio.shape[0]).astype(np.float32)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLING_RATE)
+        wav.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def percentile(values, q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def multipart_request(wav: bytes, model: str, options: dict):
+    boundary = uuid.uuid4().hex
+    fields = {"model": model, "response_format": "verbose_json", **options}
+    body = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{str(value).lower() if isinstance(value, bool) else value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    body += f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="benchmark.wav"\r\nContent-Type: audio/wav\r\n\r\n'.encode()
+    body += wav + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def model_load_seconds(metrics: str, model: str) -> float:
+    match = re.search(rf'^fastwhisper_model_load_seconds_sum{{model="{re.escape(model)}"}} (\S+)$', metrics, re.M)
+    return float(match.group(1)) if match else 0.0
+
+
+class InProcessTarget:
+    """Sends requests to the API app in this process, without a network round trip.
+
+    Requests go through the app's lifespan, middleware, preprocessing, scheduler,
+    result cache and serialization like they would over HTTP.
+    """
+
+    def __init__(self, args):
+        try:
+            from fastapi.testclient import TestClient
+        except ImportError:
+            # Starlette's TestClient is built on httpx, which the API itself does not need
+            raise SystemExit("--mode inprocess needs httpx for FastAPI's TestClient: pip install httpx")
+        from main import app
+        self.api_key = args.api_key
+        self.timeout = args.timeout
+        self.client = TestClient(app)
+        self.client.__enter__()
+        # Models are warmed up in the background once the lifespan has started
+        deadline = time.monotonic() + self.timeout
+        while (response := self.client.get("/readyz")).status_code != 200:
+            if response.json().get("status") != "starting" or time.monotonic() > deadline:
+                raise SystemExit(f"The app did not become ready: {response.text}")
+            time.sleep(0.5)
+
+    def load_model(self, model: str) -> float:
+        # A short request makes the app load the model, then its own load time is read back
+        self.transcribe(to_wav(generate_audio("tone", 1), 0), model, {})
+        return model_load_seconds(self.client.get("/metrics").text, model)
+
+    def transcribe(self, wav: bytes, model: str, options: dict):
+        body, content_type = multipart_request(wav, model, options)
+        response = self.client.post("/v1/transcriptions", content=body, timeout=self.timeout, headers={
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": content_type,
+        })
+        response.raise_for_status()
+
+    def peak_rss_bytes(self) -> int:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+
+class HttpTarget:
+    """Sends requests to a running server and reads its memory use from /metrics."""
+
+    def __init__(self, args):
+        self.url = args.url.rstrip("/")
+        self.api_key = args.api_key
+        self.timeout = args.timeout
+        self._peak_rss = 0
+        self._closed = threading.Event()
+        threading.Thread(target=self._sample_rss, daemon=True).start()
+
+    def _metrics(self) -> str:
+        with urllib.request.urlopen(f"{self.url}/metrics", timeout=self.timeout) as response:
+            return response.read().decode()
+
+    def _sample_rss(self):
+        while not self._closed.is_set():
+            try:
+                match = re.search(r"^fastwhisper_process_resident_memory_bytes (\S+)$", self._metrics(), re.M)
+                if match:
+                    self._peak_rss = max(self._peak_rss, int(float(match.group(1))))
+            except OSError:
+                pass
+            self._closed.wait(0.5)
+
+    def load_model(self, model: str) -> float:
+        # A short request makes the server load the model, then its own load time is read back
+        self.transcribe(to_wav(generate_audio("tone", 1), 0), model, {})
+        return model_load_seconds(self._metrics(), model)
+
+    def transcribe(self, wav: bytes, model: str, options: dict):
+        body, content_type = multipart_request(wav, model, options)
+        request = urllib.request.Request(f"{self.url}/v1/transcriptions", data=body, method="POST", headers={
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": content_type,
+        })
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def peak_rss_bytes(self) -> int:
+        return self._peak_rss
+
+    def close(self):
+        self._closed.set()
+
+
+def run_case(target, model: str, signal: str, duration: float, options: dict, concurrency: int, requests: int) -> dict:
+    audio = generate_audio(signal, duration)
+    seeds = itertools.count(1)
+    target.transcribe(to_wav(audio, next(seeds)), model, options)
+
+    wavs = [to_wav(audio, next(seeds)) for _ in range(requests)]
+    latencies, errors = [], 0
+
+    def send(wav):
+        start = time.perf_counter()
+        target.transcribe(wav, model, options)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(send, wav) for wav in wavs]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors += 1
+                print(f"  request failed: {type(e).__name__}: {e}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    rtfs = [latency / duration for latency in latencies]
+    return {
+        "requests": requests,
+        "errors": errors,
+        "wall_time_s": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 4),
+        "audio_seconds_per_second": round(len(latencies) * duration / elapsed, 4),
+        "latency_p50_s": round(percentile(latencies, 50), 4),
+        "latency_p95_s": round(percentile(latencies, 95), 4),
+        "latency_p99_s": round(percentile(latencies, 99), 4),
+        "rtf_mean": round(float(np.mean(rtfs)), 4) if rtfs else 0.0,
+        "rtf_p95": round(percentile(rtfs, 95), 4),
+    }
+
+
+def synthetic_result(segments: int, words_per_segment: int) -> dict:
+    rng = np.random.default_rng(0)
+    vocabulary = ["the", "model", "transcribes", "audio", "quickly", "and", "accurately", "every", "single", "word"]
+    segment_data, position = [], 0.0
+    for _ in range(segments):
+        words = []
+        for _ in range(words_per_segment):
+            length = round(float(rng.uniform(0.1, 0.6)), 2)
+            # faster-whisper returns word timestamps as numpy.float64, not Python floats
+            words.append({"word": vocabulary[int(rng.integers(len(vocabulary)))], "start": np.float64(round(position, 2)), "end": np.float64(round(position + length, 2))})
+            position += length
+        segment_data.append({"text": " ".join(word["word"] for word in words), "start": words[0]["start"], "end": words[-1]["end"], "words": words})
+    return {
+        "filename": "benchmark.wav",
+        "model": "base",
+        "detected_language": "en",
+        "language_probability": 0.99,
+        "text": " ".join(segment["text"] for segment in segment_data),
+        "segments": segment_data,
+    }
+
+
+def run_serialization(args, report: dict):
+    from fastapi.responses import JSONResponse
+    from serialization import FastJSONResponse, SUBTITLE_MEDIA_TYPES, format_result, orjson
+
+    result = synthetic_result(args.segments, args.words_per_segment)
+    encoder = "orjson" if orjson is not None else "json"
+    # The stdlib-encoded verbose_json response is the baseline the other formats are compared to
+    cases = [("verbose_json", "stdlib", lambda: JSONResponse(content=result).body)]
+    for response_format in ("verbose_json", "columnar_json"):
+        cases.append((response_format, encoder, lambda response_format=response_format: FastJSONResponse(content=format_result(result, response_format)).body))
+    for response_format in SUBTITLE_MEDIA_TYPES:
+        cases.append((response_format, "text", lambda response_format=response_format: format_result(result, response_format)[response_format].encode()))
+
+    baseline = None
+    for response_format, case_encoder, render in cases:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            body = render()
+            timings.append(time.perf_counter() - start)
+        seconds = float(np.median(timings))
+        baseline = baseline or (seconds, len(body))
+        case = f"serialization/{response_format}/{case_encoder}"
+        report["results"].append({
+            "case": case,
+            "format": response_format,
+            "encoder": case_encoder,
+            "segments": args.segments,
+            "words": args.segments * args.words_per_segment,
+            "serialize_s": round(seconds, 6),
+            "payload_bytes": len(body),
+            "speedup": round(baseline[0] / seconds, 2),
+            "size_ratio": round(len(body) / baseline[1], 3),
+        })
+        print(f"{case}: {seconds * 1000:.2f} ms, {len(body)} bytes", file=sys.stderr)
+
+
+def run_transcription(args, report: dict):
+    models = args.models.split(",")
+    signals = args.signals.split(",")
+    durations = [float(duration) for duration in args.durations.split(",")]
+    option_sets = args.options.split(",")
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    for name in option_sets:
+        if name not in OPTION_SETS:
+            raise SystemExit(f"Unknown option set {name}.")
+
+    target = InProcessTarget(args) if args.mode == "inprocess" else HttpTarget(args)
+    report["model_load_s"] = {}
+    try:
+        for model in models:
+            report["model_load_s"][model] = round(target.load_model(model), 4)
+            print(f"{model}: loaded in {report['model_load_s'][model]}s", file=sys.stderr)
+            for signal, duration, option_set, concurrency in itertools.product(signals, durations, option_sets, concurrency_levels):
+                case = f"{model}/{signal}/{duration:g}s/{option_set}/c{concurrency}"
+                result = run_case(target, model, signal, duration, OPTION_SETS[option_set], concurrency, args.requests)
+                result = {"case": case, "model": model, "signal": signal, "duration_s": duration, "options": option_set, "concurrency": concurrency, **result}
+                report["results"].append(result)
+                print(f"{case}: {result['throughput_rps']} req/s, p50 {result['latency_p50_s']}s, p95 {result['latency_p95_s']}s, RTF {result['rtf_mean']}", file=sys.stderr)
+        report["peak_rss_bytes"] = target.peak_rss_bytes()
+    finally:
+        target.close()
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    previous = {result["case"]: result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(result["case"])
+        if old is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f"{result['case']} {metric}: {old[metric]} -> {result[metric]} ({change:+.1%})")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FastWhisperAPI with synthetic audio.")
+    parser.add_argument("--mode", choices=("inprocess", "http", "serialization"), default="inprocess")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--api-key", default="dummy_api_key")
+    parser.add_argument("--models", default="base", help="Comma-separated model sizes.")
+    parser.add_argument("--signals", default="speech", help=f"Comma-separated signals from {', '.join(SIGNALS)}.")
+    parser.add_argument("--durations", default="10,60", help="Comma-separated audio durations in seconds.")
+    parser.add_argument("--options", default="default", help=f"Comma-separated option sets from {', '.join(OPTION_SETS)}.")
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated concurrency levels.")
+    parser.add_argument("--requests", type=int, default=8, help="Measured requests per case, after one warm-up request.")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--segments", type=int, default=1000, help="Segments of the synthetic result in serialization mode.")
+    parser.add_argument("--words-per-segment", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20, help="Timed repetitions per format in serialization mode.")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as a regression.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    report = {
+        "mode": args.mode,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(), "system": platform.system()},
+        "results": [],
+    }
+    if args.mode == "serialization":
+        run_serialization(args, report)
+    else:
+        run_transcription(args, report)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from faster_whisper import WhisperModel
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from constants import (
+    device,
+    compute_type,
+    SAMPLING_RATE,
+    LONG_AUDIO_WORKERS,
+    LONG_AUDIO_WORKER_THREADS,
+    LONG_AUDIO_MIN_S,
+    LONG_AUDIO_CHUNK_S,
+    LONG_AUDIO_OVERLAP_S,
+)
+from logging_config import get_logger
+from model_registry import registry
+from preprocessing import join_speech
+
+logger = get_logger()
+
+# Model replica held by each worker process, replaced when a different model is requested
+_worker_model = (None, None)
+
+
+def _transcribe_chunk(model_name: str, cpu_threads: int, audio: np.ndarray, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+    global _worker_model
+    key = (model_name, device, compute_type)
+    if _worker_model[0] != key:
+        _worker_model = (None, None)
+        _worker_model = (key, WhisperModel(model_name, device=device, compute_type=compute_type, cpu_threads=cpu_threads))
+    vad_parameters = dict(min_silence_duration_ms=min_silence_duration_ms) if vad_filter else None
+    segments, info = _worker_model[1].transcribe(audio, initial_prompt=initial_prompt, language=language, beam_size=5, vad_filter=vad_filter, vad_parameters=vad_parameters, word_timestamps=word_timestamps)
+    return list(segments), info
+
+
+def split_audio(audio: np.ndarray, speech: list, chunk_s: float = LONG_AUDIO_CHUNK_S, overlap_s: float = LONG_AUDIO_OVERLAP_S):
+    """Cut points of `audio` given the speech timestamps found by the VAD."""
+    target = int(chunk_s * SAMPLING_RATE)
+    overlap = int(overlap_s * SAMPLING_RATE)
+
+    # Cut in the middle of the first silence after each chunk reaches the target length
+    cuts, start = [], 0
+    for previous, following in zip(speech, speech[1:]):
+        if following["start"] - start >= target:
+            cut = (previous["end"] + following["start"]) // 2
+            if cut > start:
+                cuts.append((start, cut))
+                start = cut
+    cuts.append((start, audio.shape[0]))
+
+    # Speech without long enough silences is cut at fixed points with an overlap
+    chunks = []
+    for start, end in cuts:
+        while end - start > 2 * target:
+            chunks.append((start, start + target + overlap))
+            start += target
+        chunks.append((start, end))
+    return chunks
+
+
+def stitch_segments(results):
+    segments, last_end = [], 0.0
+    for offset, chunk_segments in results:
+        for segment in chunk_segments:
+            segment.start = round(segment.start + offset, 3)
+            segment.end = round(segment.end + offset, 3)
+            if segment.words:
+                for word in segment.words:
+                    word.start = round(word.start + offset, 3)
+                    word.end = round(word.end + offset, 3)
+                # Drop words already transcribed at the end of the previous chunk
+                words = [word for word in segment.words if word.start >= last_end - 0.01]
+                if not words:
+                    continue
+                if len(words) != len(segment.words):
+                    segment.words = words
+                    segment.start = words[0].start
+                    segment.text = "".join(word.word for word in words)
+            elif (segment.start + segment.end) / 2 < last_end:
+                continue
+            segment.id = len(segments) + 1
+            segments.append(segment)
+        if segments:
+            last_end = segments[-1].end
+    return segments
+
+
+class LongAudioTranscriber:
+    """Transcribes long inputs as VAD-aligned chunks across worker processes.
+
+    Each worker process holds its own model replica running with
+    `worker_threads` CTranslate2 threads. Chunk segments are shifted back to the
+    original timeline and words repeated across overlapping cuts are removed.
+    """
+
+    def __init__(self, workers: int = LONG_AUDIO_WORKERS, worker_threads: int = LONG_AUDIO_WORKER_THREADS, min_duration: float = LONG_AUDIO_MIN_S):
+        self.workers = workers
+        self.worker_threads = worker_threads
+        self.min_duration = min_duration
+        self._executor = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def start(self):
+        if not self.enabled or self._executor is not None:
+            return
+        # Spawned workers do not inherit the CTranslate2 and thread pool state of this process
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Long audio transcription started with {self.workers} worker processes of {self.worker_threads} threads.")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def can_split(self, duration: float) -> bool:
+        return self._executor is not None and duration >= self.min_duration
+
+    def transcribe(self, model_name: str, audio: np.ndarray, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+        # The VAD runs once over the whole input, for both the language detection and the cut points
+        speech = get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=min_silence_duration_ms))
+        language_probability = 1
+        if language is None:
+            # Detect once so that every chunk is transcribed in the same language
+            with registry.acquire(model_name) as model:
+                prefix = join_speech(audio, speech, model.feature_extractor.chunk_length * SAMPLING_RATE)
+                language, language_probability, _ = model.detect_language(audio=prefix)
+
+        chunks = split_audio(audio, speech)
+        logger.info(f"Transcribing {audio.shape[0] / SAMPLING_RATE:.0f}s of audio as {len(chunks)} chunk(s).")
+        futures = [
+            self._executor.submit(_transcribe_chunk, model_name, self.worker_threads, audio[start:end], initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms)
+            for start, end in chunks
+        ]
+        results = [future.result() for future in futures]
+        segments = stitch_segments([(start / SAMPLING_RATE, chunk_segments) for (start, _), (chunk_segments, _) in zip(chunks, results)])
+        info = dataclasses.replace(
+            results[0][1],
+            language=language,
+            language_probability=language_probability,
+            duration=audio.shape[0] / SAMPLING_RATE,
+            duration_after_vad=sum(chunk_info.duration_after_vad for _, chunk_info in results),
+        )
+        return segments, info
+
+
+long_audio_transcriber = LongAudioTranscriber()
@@ -1,30 +1,101 @@
 import os
-try:
-    import torch
-except ImportError:
-    torch = None
-from faster_whisper import WhisperModel
+import ctranslate2
 from fastapi.security import HTTPBearer
-# Determine device based on availability
-if torch is not None:
-    device = "cpu" if os.getenv("FORCE_CPU", "false").lower() == "true" else ("cuda" if torch.cuda.is_available() else "cpu")
-else:
-    device = "cpu"
+# Determine device based on availability, CTranslate2 reports no device when it is built without CUDA
+device = "cpu" if os.getenv("FORCE_CPU", "false").lower() == "true" else ("cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu")
 # Determine the compute type based on the device
 compute_type = "float16" if device == "cuda" else "int8"
 
-# Preload the base model
-model = WhisperModel("base", device=device, compute_type=compute_type)
 security = HTTPBearer()
-MAX_THREADS = 6
+MAX_THREADS = int(os.getenv("MAX_THREADS", "6"))
+
+# Inference scheduling: CTranslate2 threads per model call and concurrent calls per model
+CPU_COUNT = os.cpu_count() or 1
+CPU_THREADS = int(os.getenv("CPU_THREADS", "4"))
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", max(1, CPU_COUNT // max(1, CPU_THREADS)) if device == "cpu" else 2))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "64"))
+# Part of the queue only interactive API keys may fill
+INTERACTIVE_QUEUE_RESERVE = int(os.getenv("INTERACTIVE_QUEUE_RESERVE", MAX_QUEUE_SIZE // 4))
+# Audio seconds subtracted from the expected size of a queued job per second it waits
+SCHEDULER_AGING = float(os.getenv("SCHEDULER_AGING", "10"))
+
+# API keys as a JSON object mapping each key to its options, inline or in a file
+API_KEYS = os.getenv("API_KEYS", "")
+API_KEYS_FILE = os.getenv("API_KEYS_FILE", "")
+
+# Cross-request batching of decode work, disabled when the window is 0
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "0"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "1"))
+
+SAMPLING_RATE = 16000
+
+# Threads decoding and resampling uploads ahead of inference
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", max(2, CPU_COUNT // 2)))
+# Decoded uploads held in memory at once, from decoding until their transcription finishes
+DECODE_AHEAD = int(os.getenv("DECODE_AHEAD", MAX_THREADS + DECODE_WORKERS))
+
+# Upload limits: request bodies above MAX_UPLOAD_SIZE_MB are rejected while streaming,
+# files above UPLOAD_SPOOL_THRESHOLD_MB are spooled to disk instead of kept in memory
+MAX_UPLOAD_SIZE = int(float(os.getenv("MAX_UPLOAD_SIZE_MB", "1024")) * 1024 * 1024)
+UPLOAD_SPOOL_THRESHOLD = int(float(os.getenv("UPLOAD_SPOOL_THRESHOLD_MB", "64")) * 1024 * 1024)
+
+# Realtime WebSocket transcription
+REALTIME_VAD_INTERVAL_MS = int(os.getenv("REALTIME_VAD_INTERVAL_MS", "250"))
+REALTIME_PARTIAL_INTERVAL_MS = int(os.getenv("REALTIME_PARTIAL_INTERVAL_MS", "1000"))
+REALTIME_MAX_UTTERANCE_S = int(os.getenv("REALTIME_MAX_UTTERANCE_S", "30"))
+REALTIME_MAX_PENDING = int(os.getenv("REALTIME_MAX_PENDING", "4"))
+
+# Transcription result cache: in-memory LRU entries and optional SQLite tier
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "")
+RESULT_CACHE_TTL_S = int(os.getenv("RESULT_CACHE_TTL_S", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "1024"))
+
+# Asynchronous job queue
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+JOBS_POLL_INTERVAL_S = float(os.getenv("JOBS_POLL_INTERVAL_S", "5"))
+JOBS_MAX_WAIT_S = float(os.getenv("JOBS_MAX_WAIT_S", "60"))
+
+# Parallel transcription of long inputs across worker processes, disabled when there are no workers
+LONG_AUDIO_WORKERS = int(os.getenv("LONG_AUDIO_WORKERS", "0"))
+LONG_AUDIO_WORKER_THREADS = int(os.getenv("LONG_AUDIO_WORKER_THREADS", max(1, CPU_COUNT // max(1, LONG_AUDIO_WORKERS))))
+LONG_AUDIO_MIN_S = float(os.getenv("LONG_AUDIO_MIN_S", "600"))
+LONG_AUDIO_CHUNK_S = float(os.getenv("LONG_AUDIO_CHUNK_S", "180"))
+LONG_AUDIO_OVERLAP_S = float(os.getenv("LONG_AUDIO_OVERLAP_S", "1"))
+
+# Inference worker processes, disabled when the pool size is 0. WORKER_POOL_MODELS assigns
+# a model to each worker in order ("*" or a missing entry serves any model)
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "0"))
+WORKER_POOL_THREADS = int(os.getenv("WORKER_POOL_THREADS", max(1, CPU_COUNT // max(1, WORKER_POOL_SIZE))))
+WORKER_POOL_MODELS = tuple(name.strip() for name in os.getenv("WORKER_POOL_MODELS", "").split(",") if name.strip())
+
+# Add a Server-Timing header with per-stage durations to every response
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+
+# model=auto picks the largest of AUTO_MODELS (smallest first) expected to answer within AUTO_LATENCY_SLO_S
+AUTO_MODELS = tuple(name.strip() for name in os.getenv("AUTO_MODELS", "tiny,base,small,medium").split(",") if name.strip())
+AUTO_LATENCY_SLO_S = float(os.getenv("AUTO_LATENCY_SLO_S", "10"))
+
+# Language detection runs a small resident model on the first LANGUAGE_DETECTION_S seconds of speech
+LANGUAGE_DETECTION_MODEL = os.getenv("LANGUAGE_DETECTION_MODEL", "tiny")
+LANGUAGE_DETECTION_S = float(os.getenv("LANGUAGE_DETECTION_S", "30"))
+LANGUAGE_DETECTION_CACHE_SIZE = int(os.getenv("LANGUAGE_DETECTION_CACHE_SIZE", "1024"))
+
+# Model registry configuration
+PRELOAD_MODELS = tuple(name.strip() for name in os.getenv("PRELOAD_MODELS", "base").split(",") if name.strip())
+MAX_LOADED_MODELS = int(os.getenv("MAX_LOADED_MODELS", "3"))
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
 
 SUPPORTED_LANGUAGES = (
     "af", "am", "ar", "as", "az", "ba", "be", "bg", "bn", "bo", "br", "bs", "ca", "cs", "cy", "da", "de", "el", "en", "es", "et", "eu", "fa", "fi", "fo", "fr", "gl", "gu", "ha", "haw", "he", "hi", "hr", "ht", "hu", "hy", "id", "is", "it", "ja", "jw", "ka", "kk", "km", "kn", "ko", "la", "lb", "ln", "lo", "lt", "lv", "mg", "mi", "mk", "ml", "mn", "mr", "ms", "mt", "my", "ne", "nl", "nn", "no", "oc", "pa", "pl", "ps", "pt", "ro", "ru", "sa", "sd", "si", "sk", "sl", "sn", "so", "sq", "sr", "su", "sv", "sw", "ta", "te", "tg", "th", "tk", "tl", "tr", "tt", "uk", "ur", "uz", "vi", "yi", "yo", "zh", "yue",
 )
-SUPPORTED_MODELS = ("tiny.en", "tiny", "base.en", "base", "small.en", "small", "medium.en", "medium", "large-v1", "large-v2", "large-v3", "large", "distil-large-v2", "distil-medium.en", "distil-small.en", "distil-large-v3")
+SUPPORTED_MODELS = ("auto", "tiny.en", "tiny", "base.en", "base", "small.en", "small", "medium.en", "medium", "large-v1", "large-v2", "large-v3", "large", "distil-large-v2", "distil-medium.en", "distil-small.en", "distil-large-v3")
 
 SUPPORTED_EXTENSIONS = ("mp3", "mp4", "mpeg", "mpga", "m4a", "wav", "webm", "opus", "flac", "ogg")
 
-SUPPORTED_RESPONSE_FORMATS = ("text", "verbose_json")
+SUPPORTED_RESPONSE_FORMATS = ("text", "verbose_json", "columnar_json", "srt", "vtt")
 
 SUPPORTED_TIMESTAMP_GRANULARITIES = ("segment", "word")
\ No newline at end of file
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List
+
+from fastapi import HTTPException, UploadFile
+
+from api_keys import PRIORITIES, api_keys, api_keys_by_owner
+from constants import SAMPLING_RATE, JOBS_DB_PATH, JOBS_DIR, JOBS_WORKERS, JOBS_POLL_INTERVAL_S, JOBS_MAX_WAIT_S
+from logging_config import get_logger
+from preprocessing import preprocessor
+from routing import AUTO_MODEL, model_router
+from serialization import format_result, json_dumps, json_loads
+from scheduler import scheduler
+from utils import get_file_extension, is_batched, transcribe_file
+
+logger = get_logger()
+
+
+class JobQueue:
+    """Persistent queue of transcription jobs backed by SQLite.
+
+    Uploaded files are copied to `directory` and each file is processed
+    independently by `workers` background tasks, so a failing file does not
+    affect the rest of its job. Files that were running when the process stopped
+    are queued again on startup.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH, directory: str = JOBS_DIR, workers: int = JOBS_WORKERS):
+        self.path = path
+        self.directory = directory
+        self.workers = workers
+        self._db = None
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._changed = {}
+        self._wakeup = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL, options TEXT NOT NULL,
+                created REAL NOT NULL, updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL, idx INTEGER NOT NULL, filename TEXT NOT NULL, path TEXT NOT NULL,
+                status TEXT NOT NULL, result TEXT, error TEXT, PRIMARY KEY (job_id, idx)
+            );
+        """)
+        # Jobs used to be owned by the plain API key, they are now owned by its hash
+        self._db.executemany("UPDATE jobs SET owner = ? WHERE owner = ?", [(api_key.owner, api_key.key) for api_key in api_keys.values()])
+        requeued = self._db.execute("UPDATE job_files SET status = 'queued' WHERE status = 'running'").rowcount
+        self._db.commit()
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted job file(s).")
+        self._wakeup = asyncio.Event()
+
+    def start_workers(self):
+        """Starts transcribing queued files, once the inference backend is ready."""
+        self._wakeup.set()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def submit(self, owner: str, files: List[UploadFile], options: dict) -> dict:
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.directory, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        rows = []
+        for idx, file in enumerate(files):
+            path = os.path.join(job_dir, f"{idx}.{get_file_extension(file.filename)}")
+            await file.seek(0)
+            await asyncio.to_thread(self._copy, file.file, path)
+            rows.append((job_id, idx, file.filename, path, "queued"))
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT INTO jobs (id, owner, status, options, created, updated) VALUES (?, ?, 'queued', ?, ?, ?)", (job_id, owner, json.dumps(options), now, now))
+            self._db.executemany("INSERT INTO job_files (job_id, idx, filename, path, status) VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+        self._wakeup.set()
+        logger.info(f"Queued job {job_id} with {len(files)} file(s).")
+        return self.get(owner, job_id)
+
+    def get(self, owner: str, job_id: str) -> dict:
+        with self._lock:
+            job = self._db.execute("SELECT status, options, created, updated FROM jobs WHERE id = ? AND owner = ?", (job_id, owner)).fetchone()
+            if job is None:
+                raise HTTPException(status_code=404, detail={
+                    "error": {
+                        "message": f"Job {job_id} not found.",
+                        "type": "invalid_request_error",
+                        "param": "job_id",
+                        "code": 404
+                    }
+                })
+            files = self._db.execute("SELECT filename, status, result, error FROM job_files WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+        status, options, created, updated = job
+        response_format = json.loads(options)["response_format"]
+        file_data = []
+        for filename, file_status, result, error in files:
+            data = {"filename": filename, "status": file_status}
+            if result is not None:
+                data["result"] = format_result(json_loads(result), response_format)
+            if error is not None:
+                data["error"] = error
+            file_data.append(data)
+        return {"id": job_id, "status": status, "created": created, "updated": updated, "files": file_data}
+
+    async def wait(self, owner: str, job_id: str, timeout: float) -> dict:
+        job = self.get(owner, job_id)
+        timeout = min(timeout, JOBS_MAX_WAIT_S)
+        if timeout <= 0 or job["status"] in ("completed", "cancelled"):
+            return job
+        event = self._changed.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.get(owner, job_id)
+
+    def cancel(self, owner: str, job_id: str) -> dict:
+        job = self.get(owner, job_id)
+        if job["status"] not in ("completed", "cancelled"):
+            with self._lock:
+                paths = [row[0] for row in self._db.execute("SELECT path FROM job_files WHERE job_id = ? AND status = 'queued'", (job_id,))]
+                self._db.execute("UPDATE job_files SET status = 'cancelled' WHERE job_id = ? AND status = 'queued'", (job_id,))
+                self._update_job(job_id, "cancelled")
+                self._db.commit()
+            for path in paths:
+                self._remove(path)
+            self._notify(job_id)
+            logger.info(f"Cancelled job {job_id}.")
+        return self.get(owner, job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._db is None:
+                return {}
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM job_files GROUP BY status").fetchall())
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.unlink(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # The job directory still holds other files
+            pass
+
+    @staticmethod
+    def _copy(source, path: str):
+        with open(path, "wb") as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+
+    def _claim(self):
+        with self._lock:
+            row = self._db.execute("""
+                SELECT f.job_id, f.idx, f.filename, f.path, j.options, j.owner FROM job_files f JOIN jobs j ON j.id = f.job_id
+                WHERE f.status = 'queued' ORDER BY j.created, f.idx LIMIT 1
+            """).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE job_files SET status = 'running' WHERE job_id = ? AND idx = ?", row[:2])
+            self._db.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'", (time.time(), row[0]))
+            self._db.commit()
+        self._notify(row[0])
+        return row
+
+    def _finish(self, job_id: str, idx: int, status: str, result: dict = None, error: str = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE job_files SET status = ?, result = ?, error = ? WHERE job_id = ? AND idx = ? AND status = 'running'",
+                (status, json_dumps(result) if result is not None else None, error, job_id, idx),
+            )
+            remaining = self._db.execute("SELECT COUNT(*) FROM job_files WHERE job_id = ? AND status NOT IN ('completed', 'failed', 'cancelled')", (job_id,)).fetchone()[0]
+            if not remaining:
+                self._db.execute("UPDATE jobs SET status = 'completed', updated = ? WHERE id = ? AND status != 'cancelled'", (time.time(), job_id))
+            else:
+                self._update_job(job_id, None)
+            self._db.commit()
+        self._notify(job_id)
+
+    def _requeue(self, job_id: str, idx: int):
+        with self._lock:
+            self._db.execute("UPDATE job_files SET status = 'queued' WHERE job_id = ? AND idx = ? AND status = 'running'", (job_id, idx))
+            self._db.commit()
+
+    def _update_job(self, job_id: str, status: str):
+        if status is None:
+            self._db.execute("UPDATE jobs SET updated = ? WHERE id = ?", (time.time(), job_id))
+        else:
+            self._db.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (status, time.time(), job_id))
+
+    def _notify(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _work(self):
+        while True:
+            claimed = self._claim()
+            if claimed is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOBS_POLL_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, idx, filename, path, options, owner = claimed
+            options = json.loads(options)
+            api_key = api_keys_by_owner.get(owner)
+            try:
+                # Background jobs never compete with interactive requests of the same key
+                with scheduler.admit(api_key, priority=PRIORITIES["batch"]) as admission:
+                    async with scheduler.prepare(admission):
+                        with open(path, "rb") as file:
+                            audio = await preprocessor.decode(file, options["model"])
+                        model = options["model"]
+                        if model == AUTO_MODEL:
+                            model = model_router.route(audio.shape[0] / SAMPLING_RATE)
+                        result = await scheduler.run(
+                            model, transcribe_file, filename, audio, model, options["initial_prompt"], options["language"],
+                            options["word_timestamps"], options["vad_filter"], options["min_silence_duration_ms"],
+                            admission=admission, cost=audio.shape[0] / SAMPLING_RATE,
+                            exclusive=not is_batched(audio, options["vad_filter"]),
+                        )
+                # A result that cannot be stored fails the file instead of the worker
+                self._finish(job_id, idx, "completed", result=result)
+            except HTTPException as e:
+                if e.status_code in (429, 503):
+                    # The scheduler is saturated, leave the file queued and back off
+                    self._requeue(job_id, idx)
+                    await asyncio.sleep(float(e.headers.get("Retry-After", 1)))
+                    continue
+                self._finish(job_id, idx, "failed", error=e.detail["error"]["message"])
+            except Exception as e:
+                logger.error(f"An error occurred during transcription of job {job_id} file {filename}: {str(e)}")
+                self._finish(job_id, idx, "failed", error=str(e))
+            self._remove(path)
+
+
+job_queue = JobQueue()
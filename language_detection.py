@@ -0,0 +1,89 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from fastapi import UploadFile
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from api_keys import ApiKey
+from constants import SAMPLING_RATE, LANGUAGE_DETECTION_MODEL, LANGUAGE_DETECTION_S, LANGUAGE_DETECTION_CACHE_SIZE
+from logging_config import get_logger
+from model_registry import registry
+from preprocessing import join_speech, preprocessor
+from result_cache import hash_upload
+from scheduler import Admission, scheduler
+
+logger = get_logger()
+
+# Only the beginning of the file is searched for speech
+VAD_WINDOW_FACTOR = 10
+TOP_LANGUAGES = 5
+
+
+def speech_prefix(audio: np.ndarray, seconds: float) -> np.ndarray:
+    target = int(seconds * SAMPLING_RATE)
+    window = audio[:target * VAD_WINDOW_FACTOR]
+    return join_speech(window, get_speech_timestamps(window, VadOptions()), target)
+
+
+class LanguageDetector:
+    """Detects the spoken language with a small model kept resident in the registry.
+
+    Detection only looks at the first `seconds` of speech. Results are cached by
+    the content hash of the upload, so a file is only analysed once.
+    """
+
+    def __init__(self, model: str = LANGUAGE_DETECTION_MODEL, seconds: float = LANGUAGE_DETECTION_S, cache_size: int = LANGUAGE_DETECTION_CACHE_SIZE):
+        self.model = model
+        self.seconds = seconds
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        registry.pin(self.model)
+        registry.preload([self.model])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"model": self.model, "hits": self.hits, "misses": self.misses, "entries": len(self._cache)}
+
+    def detect(self, audio: np.ndarray) -> dict:
+        audio = speech_prefix(audio, self.seconds)
+        with registry.acquire(self.model) as model:
+            language, probability, all_probabilities = model.detect_language(
+                audio=audio, language_detection_segments=max(1, math.ceil(self.seconds / 30)),
+            )
+        return {
+            "detected_language": language,
+            "language_probability": probability,
+            "language_probabilities": dict(all_probabilities[:TOP_LANGUAGES]),
+        }
+
+    async def detect_upload(self, file: UploadFile, audio: np.ndarray = None, api_key: ApiKey = None, admission: Admission = None) -> dict:
+        """Detects the language of an upload, within the place of `admission` when given."""
+        key = await hash_upload(file)
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+        if audio is None:
+            # Only the window searched for speech is decoded
+            audio = await preprocessor.decode(file.file, self.model, max_seconds=self.seconds * VAD_WINDOW_FACTOR)
+        cost = min(audio.shape[0] / SAMPLING_RATE, self.seconds)
+        result = await scheduler.run(self.model, self.detect, audio, admission=admission, api_key=api_key, cost=cost)
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+
+language_detector = LanguageDetector()
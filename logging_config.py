@@ -1,11 +1,15 @@
 import logging
+import os
 from logging.handlers import RotatingFileHandler
 
 def get_logger():
     logger = logging.getLogger(__name__)
+    # Every module asks for the logger, but the handler must only be attached once
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
 
-    handler = RotatingFileHandler("app.log", maxBytes=10000, backupCount=5)
+    handler = RotatingFileHandler("app.log", maxBytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))), backupCount=5)
     handler.setLevel(logging.INFO)
 
     formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -1,32 +1,88 @@
 
-import concurrent.futures
 import asyncio
 import os
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
+from startup import startup
 
-from faster_whisper import WhisperModel
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form, Depends, status
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form, Depends, WebSocket, status
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse
+from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
 
 # Constants
-from constants import device, compute_type, security, MAX_THREADS
+from constants import device, security, PRELOAD_MODELS
+
+# Model registry and inference scheduler
+from model_registry import registry
+from scheduler import scheduler
+from preprocessing import preprocessor
+from batching import batching_engine
+from chunked import long_audio_transcriber
+from worker_pool import worker_pool
+from serialization import FastJSONResponse, SUBTITLE_MEDIA_TYPES, format_result
+from metrics import BATCH_SIZE, BATCH_QUEUE_WAIT, MetricsMiddleware, observe_upload, render_metrics, timed
+from result_cache import result_cache
+from jobs import job_queue
+from language_detection import language_detector
+from routing import model_router
 
 # Responses
 from responses import SUCCESSFUL_RESPONSE, BAD_REQUEST_RESPONSE
-from responses import VALIDATION_ERROR_RESPONSE, INTERNAL_SERVER_ERROR_RESPONSE
+from responses import VALIDATION_ERROR_RESPONSE, INTERNAL_SERVER_ERROR_RESPONSE, TOO_MANY_REQUESTS_RESPONSE, REQUEST_TOO_LARGE_RESPONSE
+
+# Upload handling
+from uploads import UploadSizeLimitMiddleware
 
 # Logging configuration
 from logging_config import get_logger
 logger = get_logger()
 
-app = FastAPI()
+async def warm_up():
+    try:
+        if worker_pool.enabled:
+            # Inference runs in the worker processes; this returns once each has loaded its model
+            await asyncio.to_thread(worker_pool.start)
+        else:
+            await asyncio.to_thread(registry.preload, PRELOAD_MODELS)
+        await asyncio.to_thread(language_detector.start)
+        startup.mark("models")
+        # Queued jobs would otherwise fail while the inference workers are starting
+        job_queue.start_workers()
+        startup.ready = True
+        logger.info(f"Ready in {startup.summary()['total']:.2f}s ({', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in startup.phases.items())}).")
+    except Exception as e:
+        startup.error = str(e)
+        logger.error(f"Model warm-up failed: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup.mark("imports")
+    scheduler.start()
+    preprocessor.start()
+    batching_engine.start()
+    long_audio_transcriber.start()
+    job_queue.start()
+    startup.mark("services")
+    # Models load in the background; /readyz reports when they are warm
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+    await job_queue.stop()
+    long_audio_transcriber.shutdown()
+    batching_engine.shutdown()
+    worker_pool.shutdown()
+    preprocessor.shutdown()
+    scheduler.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -37,7 +93,8 @@ app.add_middleware(
 
 # Helper functions
 from utils import authenticate_user
-from utils import process_file, validate_parameters
+from utils import process_files, stream_files, validate_file_count, validate_files, validate_parameters
+from realtime import realtime_transcription
 
 # Routes
 @app.get("/", response_class=RedirectResponse)
@@ -60,13 +117,15 @@ def home():
                 <h4>Parameters:</h4>
                 <ul>
                     <li>file: A list of audio files to transcribe. This is a required parameter.</li>
-                    <li>model: The size of the model to use for transcription. This is an optional parameter. The options are 'large', 'medium', 'small', 'base', 'tiny'. Default is 'base'.</li>
+                    <li>model: The size of the model to use for transcription. This is an optional parameter. The options are 'large', 'medium', 'small', 'base', 'tiny', or 'auto' to pick a model from the audio duration and current load. Default is 'base'.</li>
                     <li>language: This parameter specifies the language of the audio files. It is optional, with accepted values being lowercase ISO-639-1 format. (e.g., 'en' for English). If not provided, the system will automatically detect the language.</li>
                     <li>initial_prompt: This optional parameter provides an initial prompt to guide the model's transcription process. It can be used to pass a dictionary of the correct spellings of words and to provide context for better understanding speech, thus maintaining a consistent writing style.</li>
                     <li>vad_filter: Whether to apply a voice activity detection filter. This is an optional parameter. Default is False.</li>
                     <li>min_silence_duration_ms: The minimum duration of silence to be considered as a pause. This is an optional parameter. Default is 1000.</li>
-                    <li>response_format: The format of the response. This is an optional parameter. The options are 'text', 'verbose_json'. Default is 'text'.</li>
-                    <li>timestamp_granularities: The granularity of the timestamps. This is an optional parameter. The options are 'segment', 'word'. Default is 'segment'. This is a string and not an array like the OpenAI model, and the timestamps will be returned only if the response_format is set to verbose_json.</li>
+                    <li>response_format: The format of the response. This is an optional parameter. The options are 'text', 'verbose_json', 'columnar_json' (segments and words as parallel start/end/text arrays), 'srt', 'vtt'. Default is 'text'.</li>
+                    <li>timestamp_granularities: The granularity of the timestamps. This is an optional parameter. The options are 'segment', 'word'. Default is 'segment'. This is a string and not an array like the OpenAI model, and the timestamps will be returned only if the response_format is set to verbose_json or columnar_json.</li>
+                    <li>stream: Whether to stream each segment as soon as it is transcribed, as Server-Sent Events or as newline-delimited JSON when the Accept header is 'application/x-ndjson'. This is an optional parameter. Default is False.</li>
+                    <li>detect_language: When no language is given, detect it with the small model of /v1/detect-language (reusing a previous detection of the same file) instead of the transcription model. This is an optional parameter. Default is False.</li>
                 </ul>
                 <h4>Example:</h4>
                 <ul>
@@ -95,6 +154,36 @@ def home():
                     <li>-F "timestamp_granularities=segment"</li>
                 </ul>
             </li>
+            <li>
+                <h3>/v1/detect-language</h3>
+                <p>Method: POST</p>
+                <p>Description: Detects the language of an audio file from its first seconds of speech with a small resident model, and returns the detected language with its probability and the probabilities of the most likely languages.</p>
+            </li>
+            <li>
+                <h3>/v1/jobs</h3>
+                <p>Method: POST</p>
+                <p>Description: Queues a transcription job with the same parameters as /v1/transcriptions and returns its id immediately. Use GET /v1/jobs/{id} (optionally with ?wait=seconds to long-poll) to get the status and results of each file, and DELETE /v1/jobs/{id} to cancel it.</p>
+            </li>
+            <li>
+                <h3>/v1/realtime</h3>
+                <p>Method: WebSocket</p>
+                <p>Description: Transcribes live audio. Send binary frames of 16-bit PCM or Opus audio and receive partial and final segments as JSON messages.</p>
+            </li>
+            <li>
+                <h3>/healthz, /readyz</h3>
+                <p>Method: GET</p>
+                <p>Description: Liveness and readiness probes. /healthz answers as soon as the server is up, /readyz returns 503 until the configured models are loaded, along with the duration of each startup phase.</p>
+            </li>
+            <li>
+                <h3>/metrics</h3>
+                <p>Method: GET</p>
+                <p>Description: Exposes Prometheus metrics: per-stage latency histograms, real-time factor, queue depth, in-flight requests, model loads and memory use.</p>
+            </li>
+            <li>
+                <h3>/stats</h3>
+                <p>Method: GET</p>
+                <p>Description: Returns model registry, scheduler, batching, result cache, job queue and worker pool statistics.</p>
+            </li>
             <li>
                 <h3>/</h3>
                 <p>Method: GET</p>
@@ -106,11 +195,14 @@ def home():
           responses={
               200: SUCCESSFUL_RESPONSE,
               400: BAD_REQUEST_RESPONSE,
+              413: REQUEST_TOO_LARGE_RESPONSE,
               422: VALIDATION_ERROR_RESPONSE,
+              429: TOO_MANY_REQUESTS_RESPONSE,
               500: INTERNAL_SERVER_ERROR_RESPONSE,
           }
 )
-async def transcribe_audio(credentials: HTTPAuthorizationCredentials = Depends(security),
+async def transcribe_audio(request: Request,
+                           credentials: HTTPAuthorizationCredentials = Depends(security),
                            file: List[UploadFile] = File(...),
                            model: str = Form("base"),
                            language: str = Form(None),
@@ -118,45 +210,157 @@ async def transcribe_audio(credentials: HTTPAuthorizationCredentials = Depends(s
                            vad_filter: bool = Form(False),
                            min_silence_duration_ms: int = Form(1000),
                            response_format: str = Form("text"),
-                           timestamp_granularities: str = Form("segment")):
-    user = authenticate_user(credentials)
+                           timestamp_granularities: str = Form("segment"),
+                           stream: bool = Form(False),
+                           detect_language: bool = Form(False)):
+    api_key = authenticate_user(credentials)
     validate_parameters(file, language, model, vad_filter, min_silence_duration_ms, response_format, timestamp_granularities)
     word_timestamps = timestamp_granularities == "word"
-    m = WhisperModel(model, device=device, compute_type=compute_type)
-    
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = []
-        for f in file:
-            future = executor.submit(asyncio.run, process_file(f, m, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms))
-            futures.append(future)
-    
-        transcriptions = {}
-        for i, future in enumerate(concurrent.futures.as_completed(futures), start=1):
-            try:
-                result = future.result()
-                if len(file) > 1:
-                    if response_format == "text":
-                        transcriptions[f"File {i}"] = {"text": result["text"]}
-                    else:
-                        transcriptions[f"File {i}"] = result
-                else:
-                    if response_format == "text":
-                        transcriptions = {"text": result["text"]}
-                    else:
-                        transcriptions = result
-            except Exception as e:
-                logger.error(f"An error occurred during transcription: {str(e)}")
-                raise HTTPException(status_code=500, detail=str(e))
-    
-        logger.info(f"Transcription completed for {len(file)} file(s).")
-        return JSONResponse(content=transcriptions)
+    observe_upload(model)
+
+    if stream:
+        # Server-Sent Events by default, newline-delimited JSON when requested
+        sse = "application/x-ndjson" not in request.headers.get("accept", "")
+        worker_pool.check_ready()
+        scheduler.check_capacity(api_key)
+        return StreamingResponse(
+            # Streamed segments carry their timestamps in every format but text
+            stream_files(file, model, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms, response_format != "text", sse, detect_language, api_key),
+            media_type="text/event-stream" if sse else "application/x-ndjson",
+        )
+
+    validate_file_count(file, api_key)
+    worker_pool.check_ready()
+    try:
+        results = await process_files(file, model, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms, detect_language, api_key=api_key)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred during transcription: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info(f"Transcription completed for {len(file)} file(s).")
+    with timed("serialize", model):
+        if len(file) > 1:
+            return FastJSONResponse(content={f"File {i}": format_result(result, response_format) for i, result in enumerate(results, start=1)})
+        if response_format in SUBTITLE_MEDIA_TYPES:
+            return PlainTextResponse(format_result(results[0], response_format)[response_format], media_type=SUBTITLE_MEDIA_TYPES[response_format])
+        return FastJSONResponse(content=format_result(results[0], response_format))
+
+@app.post('/v1/detect-language',
+          responses={
+              400: BAD_REQUEST_RESPONSE,
+              413: REQUEST_TOO_LARGE_RESPONSE,
+              422: VALIDATION_ERROR_RESPONSE,
+              429: TOO_MANY_REQUESTS_RESPONSE,
+              500: INTERNAL_SERVER_ERROR_RESPONSE,
+          }
+)
+async def detect_language(credentials: HTTPAuthorizationCredentials = Depends(security),
+                          file: UploadFile = File(...)):
+    api_key = authenticate_user(credentials)
+    validate_files([file])
+    scheduler.check_capacity(api_key)
+    try:
+        result = await language_detector.detect_upload(file, api_key=api_key)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred during language detection: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return JSONResponse(content={"filename": file.filename, **result})
+
+@app.post('/v1/jobs',
+          status_code=202,
+          responses={
+              400: BAD_REQUEST_RESPONSE,
+              413: REQUEST_TOO_LARGE_RESPONSE,
+              422: VALIDATION_ERROR_RESPONSE,
+          }
+)
+async def create_job(credentials: HTTPAuthorizationCredentials = Depends(security),
+                     file: List[UploadFile] = File(...),
+                     model: str = Form("base"),
+                     language: str = Form(None),
+                     initial_prompt: str = Form(None),
+                     vad_filter: bool = Form(False),
+                     min_silence_duration_ms: int = Form(1000),
+                     response_format: str = Form("text"),
+                     timestamp_granularities: str = Form("segment")):
+    api_key = authenticate_user(credentials)
+    validate_parameters(file, language, model, vad_filter, min_silence_duration_ms, response_format, timestamp_granularities)
+    job = await job_queue.submit(api_key.owner, file, {
+        "model": model,
+        "language": language,
+        "initial_prompt": initial_prompt,
+        "vad_filter": vad_filter,
+        "min_silence_duration_ms": min_silence_duration_ms,
+        "word_timestamps": timestamp_granularities == "word",
+        "response_format": response_format,
+    })
+    return JSONResponse(status_code=202, content=job)
+
+@app.get('/v1/jobs/{job_id}')
+async def get_job(job_id: str, wait: float = 0, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    api_key = authenticate_user(credentials)
+    return FastJSONResponse(content=await job_queue.wait(api_key.owner, job_id, wait))
+
+# Runs on the event loop, since cancelling wakes long-polling requests through an asyncio.Event
+@app.delete('/v1/jobs/{job_id}')
+async def cancel_job(job_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    api_key = authenticate_user(credentials)
+    return JSONResponse(content=job_queue.cancel(api_key.owner, job_id))
+
+@app.websocket('/v1/realtime')
+async def realtime(websocket: WebSocket,
+                   model: str = "base",
+                   language: str = None,
+                   initial_prompt: str = None,
+                   min_silence_duration_ms: int = 500,
+                   timestamp_granularities: str = "segment",
+                   encoding: str = "pcm16",
+                   sample_rate: int = 16000):
+    await realtime_transcription(websocket, model, language, initial_prompt, min_silence_duration_ms, timestamp_granularities, encoding, sample_rate)
+
+@app.get('/healthz')
+def healthz():
+    return JSONResponse(content={"status": "ok"})
+
+@app.get('/readyz')
+def readyz():
+    summary = startup.summary()
+    if not startup.ready:
+        return JSONResponse(status_code=503, content={"status": "failed" if startup.error else "starting", **summary})
+    return JSONResponse(content={"status": "ready", **summary})
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get('/stats')
+def stats():
+    return JSONResponse(content={
+        "models": registry.stats(),
+        "scheduler": scheduler.stats(),
+        "result_cache": result_cache.stats(),
+        "jobs": job_queue.stats(),
+        "language_detection": language_detector.stats(),
+        "routing": model_router.stats(),
+        "startup": startup.summary(),
+        "worker_pool": worker_pool.stats() if worker_pool.enabled else None,
+        "batching": {
+            "enabled": batching_engine.enabled,
+            BATCH_SIZE.name: BATCH_SIZE.snapshot(),
+            BATCH_QUEUE_WAIT.name: BATCH_QUEUE_WAIT.snapshot(),
+        },
+    })
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(
         status_code=exc.status_code,
         content=exc.detail,
+        headers=exc.headers,
     )
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
@@ -0,0 +1,271 @@
+import bisect
+import contextvars
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from constants import SERVER_TIMING
+
+PREFIX = "fastwhisper_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labels: dict, extra: str = "") -> str:
+    items = [f'{name}="{str(value)}"' for name, value in labels.items()]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def render(self) -> list:
+        lines = [f"# HELP {PREFIX}{self.name} {self.documentation}", f"# TYPE {PREFIX}{self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            lines.extend(child.render(PREFIX + self.name, dict(zip(self.labelnames, key))))
+        return lines
+
+
+class _CounterValue:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def render(self, name: str, labels: dict) -> list:
+        return [f"{name}_total{_format_labels(labels)} {self._value}"]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+                cumulative += count
+                buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            return {"count": self._count, "sum": round(self._sum, 6), "buckets": buckets}
+
+    def render(self, name: str, labels: dict) -> list:
+        snapshot = self.snapshot()
+        lines = []
+        for bound, count in snapshot["buckets"].items():
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_format_labels(labels, le)} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {snapshot['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {snapshot['count']}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def snapshot(self) -> dict:
+        return self.labels().snapshot()
+
+    def mean(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+        if child is None or not child._count:
+            return None
+        return child._sum / child._count
+
+
+class Gauge(_Metric):
+    """Gauge whose samples are read from `function` at collection time.
+
+    `function` returns a number, or a list of (labels, value) pairs for labelled gauges.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function, labelnames=()):
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {PREFIX}{self.name} {self.documentation}", f"# TYPE {PREFIX}{self.name} {self.kind}"]
+        value = self.function()
+        samples = value if isinstance(value, list) else [({}, value)]
+        for labels, sample in samples:
+            lines.append(f"{PREFIX}{self.name}{_format_labels(labels)} {sample}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def resident_memory_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is the peak resident size, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+STAGE_SECONDS = Histogram(
+    "stage_seconds",
+    "Time spent per request stage: upload (request body received), audio_decode, vad (VAD, feature extraction and "
+    "language detection before decoding starts), encode, generate and serialize.",
+    labelnames=("stage", "model"),
+)
+REAL_TIME_FACTOR = Histogram("real_time_factor", "Transcription processing time divided by audio duration.", (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0), labelnames=("model",))
+MODEL_LOADS = Counter("model_loads", "Number of models loaded into memory.", labelnames=("model",))
+MODEL_LOAD_SECONDS = Histogram("model_load_seconds", "Time spent loading a model.", labelnames=("model",))
+BATCH_SIZE = Histogram("batch_size", "Number of audio chunks per batched decode call.", (1, 2, 4, 8, 16, 32, 64))
+BATCH_QUEUE_WAIT = Histogram("batch_queue_wait_seconds", "Time an audio chunk waits before its batch is dispatched.", (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+Gauge("process_resident_memory_bytes", "Resident memory of the API process.", resident_memory_bytes)
+
+_in_flight = 0
+Gauge("in_flight_requests", "Number of HTTP requests being processed.", lambda: _in_flight)
+
+# Stage timings of the current request, reported in the Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+_request_start = contextvars.ContextVar("request_start", default=None)
+_thread_state = threading.local()
+
+
+def observe_stage(stage: str, model: str, seconds: float):
+    STAGE_SECONDS.labels(stage=stage, model=model).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str, model: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, model, time.perf_counter() - start)
+
+
+def observe_upload(model: str):
+    start = _request_start.get()
+    if start is not None:
+        observe_stage("upload", model, time.perf_counter() - start)
+
+
+def timed_method(func, stage: str, model: str):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _thread_state.nested = getattr(_thread_state, "nested", 0.0) + elapsed
+            observe_stage(stage, model, elapsed)
+    return wrapper
+
+
+def timed_iterator(iterable, stage: str, model: str):
+    # Time spent in timed methods called while producing the items is not counted twice
+    iterator, total = iter(iterable), 0.0
+    try:
+        while True:
+            _thread_state.nested = 0.0
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            finally:
+                total += time.perf_counter() - start - _thread_state.nested
+            yield item
+    except StopIteration:
+        return
+    finally:
+        observe_stage(stage, model, total)
+
+
+class MetricsMiddleware:
+    """Tracks in-flight requests and adds a Server-Timing header when enabled."""
+
+    def __init__(self, app, server_timing: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        global _in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        _request_timings.set(timings)
+        _request_start.set(time.perf_counter())
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings:
+                value = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", value.encode())]
+            await send(message)
+
+        _in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_timing if self.server_timing else send)
+        finally:
+            _in_flight -= 1
@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from faster_whisper import WhisperModel
+
+from constants import device, compute_type, CPU_THREADS, MODEL_CONCURRENCY, MAX_LOADED_MODELS, MODEL_MEMORY_BUDGET_MB
+from logging_config import get_logger
+from metrics import Gauge, MODEL_LOADS, MODEL_LOAD_SECONDS, timed_method
+
+logger = get_logger()
+
+# Approximate parameter counts (in millions) used to estimate the resident size of a model
+MODEL_PARAMETERS = {
+    "tiny": 39, "base": 74, "small": 244, "medium": 769, "large": 1550,
+    "distil-small": 166, "distil-medium": 394, "distil-large": 756,
+}
+BYTES_PER_PARAMETER = {"int8": 1, "int8_float16": 1, "int8_bfloat16": 1, "int8_float32": 1, "float16": 2, "bfloat16": 2, "float32": 4}
+
+
+def estimate_model_memory_mb(name: str, compute_type: str) -> int:
+    family = name.split(".")[0]
+    if family.startswith("large"):
+        family = "large"
+    elif family.startswith("distil-large"):
+        family = "distil-large"
+    parameters = MODEL_PARAMETERS.get(family, MODEL_PARAMETERS["large"])
+    return parameters * BYTES_PER_PARAMETER.get(compute_type, 4)
+
+
+class _Entry:
+    __slots__ = ("model", "refcount", "memory_mb")
+
+    def __init__(self, model: WhisperModel, memory_mb: int):
+        self.model = model
+        self.refcount = 0
+        self.memory_mb = memory_mb
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded WhisperModel instances with LRU eviction.
+
+    Models are keyed by (name, device, compute_type). A model that is checked out
+    through `acquire` is reference counted and never evicted while in use; the
+    registry may temporarily exceed its budget when every loaded model is busy.
+    Pinned models are never evicted.
+    """
+
+    def __init__(self, max_models: int = MAX_LOADED_MODELS, memory_budget_mb: int = MODEL_MEMORY_BUDGET_MB):
+        self.max_models = max_models
+        self.memory_budget_mb = memory_budget_mb
+        self._entries = OrderedDict()
+        self._pinned = set()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_time_total = 0.0
+        self.load_time_max = 0.0
+
+    @contextmanager
+    def acquire(self, name: str, device: str = device, compute_type: str = compute_type):
+        key = (name, device, compute_type)
+        model = self._checkout(key)
+        try:
+            yield model
+        finally:
+            self._release(key)
+
+    def preload(self, names):
+        for name in names:
+            with self.acquire(name):
+                logger.info(f"Preloaded model {name} on {device} ({compute_type}).")
+
+    def pin(self, name: str):
+        with self._lock:
+            self._pinned.add(name)
+
+    def loaded_models(self):
+        with self._lock:
+            return [key[0] for key in self._entries]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "loads": self.loads,
+                "load_time_total": round(self.load_time_total, 3),
+                "load_time_max": round(self.load_time_max, 3),
+                "max_models": self.max_models,
+                "memory_budget_mb": self.memory_budget_mb,
+                "memory_used_mb": sum(entry.memory_mb for entry in self._entries.values()),
+                "models": [
+                    {"model": key[0], "device": key[1], "compute_type": key[2], "in_use": entry.refcount, "memory_mb": entry.memory_mb, "pinned": key[0] in self._pinned}
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+    def _checkout(self, key) -> WhisperModel:
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.refcount += 1
+                    self.hits += 1
+                    return entry.model
+                event = self._loading.get(key)
+                if event is None:
+                    # This thread loads the model, concurrent callers wait for it
+                    event = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            event.wait()
+
+        try:
+            name, model_device, model_compute_type = key
+            start = time.perf_counter()
+            model = WhisperModel(name, device=model_device, compute_type=model_compute_type, cpu_threads=CPU_THREADS, num_workers=MODEL_CONCURRENCY)
+            elapsed = time.perf_counter() - start
+            model.encode = timed_method(model.encode, "encode", name)
+            MODEL_LOADS.labels(model=name).inc()
+            MODEL_LOAD_SECONDS.labels(model=name).observe(elapsed)
+            logger.info(f"Loaded model {name} on {model_device} ({model_compute_type}) in {elapsed:.2f}s.")
+        except Exception:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+            raise
+
+        with self._lock:
+            entry = _Entry(model, estimate_model_memory_mb(name, model_compute_type))
+            entry.refcount = 1
+            self._entries[key] = entry
+            self.loads += 1
+            self.load_time_total += elapsed
+            self.load_time_max = max(self.load_time_max, elapsed)
+            self._evict()
+            del self._loading[key]
+        event.set()
+        return model
+
+    def _release(self, key):
+        with self._lock:
+            self._entries[key].refcount -= 1
+            self._evict()
+
+    def _over_budget(self) -> bool:
+        if self.max_models > 0 and len(self._entries) > self.max_models:
+            return True
+        if self.memory_budget_mb > 0:
+            return sum(entry.memory_mb for entry in self._entries.values()) > self.memory_budget_mb
+        return False
+
+    def _evict(self):
+        # Walk the entries from least to most recently used, skipping models in use
+        for key in list(self._entries):
+            if not self._over_budget():
+                return
+            if self._entries[key].refcount == 0 and key[0] not in self._pinned:
+                del self._entries[key]
+                self.evictions += 1
+                logger.info(f"Evicted model {key[0]} ({key[2]}) from the registry.")
+        if self._over_budget():
+            logger.warning("Model registry is over budget because all loaded models are in use.")
+
+
+registry = ModelRegistry()
+Gauge("loaded_models", "Number of models held by the model registry.", lambda: len(registry.loaded_models()))
+Gauge("model_memory_bytes", "Estimated memory used by the models held by the model registry.", lambda: registry.stats()["memory_used_mb"] * 1024 * 1024)
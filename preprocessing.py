@@ -0,0 +1,183 @@
+import asyncio
+import contextvars
+import io
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+
+import av
+import numpy as np
+from faster_whisper.audio import decode_audio
+
+from constants import SAMPLING_RATE, DECODE_WORKERS
+from logging_config import get_logger
+from metrics import timed
+
+logger = get_logger()
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _source_buffer(stream: BinaryIO):
+    # Spooled uploads still held in memory are read through their BytesIO, files on disk are mapped
+    source = getattr(stream, "_file", stream)
+    if isinstance(source, io.BytesIO):
+        return source.getbuffer(), False
+    try:
+        return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ), True
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None, False
+
+
+def _find_samples(buffer):
+    """Returns (dtype, offset, count) of the samples of a 16 kHz mono PCM16 or float32 WAV file, or None."""
+    if len(buffer) < 12 or bytes(buffer[0:4]) != b"RIFF" or bytes(buffer[8:12]) != b"WAVE":
+        return None
+    position, sample_format = 12, None
+    while position + 8 <= len(buffer):
+        chunk_id = bytes(buffer[position:position + 4])
+        chunk_size, = struct.unpack_from("<I", buffer, position + 4)
+        body = position + 8
+        if chunk_id == b"fmt " and chunk_size >= 16:
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", buffer, body)
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                audio_format, = struct.unpack_from("<H", buffer, body + 24)
+            if channels != 1 or sample_rate != SAMPLING_RATE:
+                return None
+            if audio_format == WAVE_FORMAT_PCM and bits == 16:
+                sample_format = np.dtype("<i2")
+            elif audio_format == WAVE_FORMAT_IEEE_FLOAT and bits == 32:
+                sample_format = np.dtype("<f4")
+            else:
+                return None
+        elif chunk_id == b"data":
+            if sample_format is None:
+                return None
+            # Streamed WAV files leave the data size unset
+            size = min(chunk_size, len(buffer) - body)
+            return sample_format, body, size // sample_format.itemsize
+        position = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def read_wav(stream: BinaryIO, max_samples: int = None):
+    """Reads 16 kHz mono PCM16 or float32 WAV audio without decoding or resampling.
+
+    Returns None for any other input, and at most `max_samples` samples. Float32 samples in a file on disk are
+    returned as a view of the mapped file, PCM16 samples are converted in a
+    single pass from the source buffer.
+    """
+    buffer, mapped = _source_buffer(stream)
+    if buffer is None:
+        return None
+    try:
+        found = _find_samples(buffer)
+        if found is None:
+            return None
+        sample_format, offset, count = found
+        if max_samples is not None:
+            count = min(count, max_samples)
+        samples = np.frombuffer(buffer, dtype=sample_format, count=count, offset=offset)
+        if sample_format.kind == "f":
+            if mapped and samples.flags.aligned:
+                # The array keeps the mapping alive
+                buffer = None
+                return samples
+            return samples.astype(np.float32)
+        audio = np.empty(count, dtype=np.float32)
+        np.multiply(samples, 1 / 32768, out=audio, casting="unsafe")
+        return audio
+    finally:
+        samples = None
+        if isinstance(buffer, memoryview):
+            buffer.release()
+        elif buffer is not None:
+            buffer.close()
+
+
+def decode_prefix(stream: BinaryIO, max_samples: int) -> np.ndarray:
+    """Decodes and resamples only the first `max_samples` samples of the audio."""
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLING_RATE)
+    chunks, length = [], 0
+    with av.open(stream, mode="r", metadata_errors="ignore") as container:
+        frames = container.decode(audio=0)
+        while length < max_samples:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                frame = None
+            except av.error.InvalidDataError:
+                continue
+            if frame is not None:
+                frame.pts = None
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+                length += chunks[-1].shape[0]
+            if frame is None:
+                break
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)[:max_samples].astype(np.float32) / 32768.0
+
+
+def load_audio(stream: BinaryIO, model_name: str, max_seconds: float = None) -> np.ndarray:
+    max_samples = int(max_seconds * SAMPLING_RATE) if max_seconds is not None else None
+    with timed("audio_decode", model_name):
+        audio = read_wav(stream, max_samples)
+        if audio is None:
+            stream.seek(0)
+            if max_samples is not None:
+                audio = decode_prefix(stream, max_samples)
+            else:
+                audio = decode_audio(stream, sampling_rate=SAMPLING_RATE)
+    return audio
+
+
+def join_speech(audio: np.ndarray, speech: list, max_samples: int) -> np.ndarray:
+    """Concatenates the speech of `audio` found by the VAD, up to `max_samples` samples."""
+    chunks, length = [], 0
+    for timestamps in speech:
+        chunks.append(audio[timestamps["start"]:timestamps["end"]])
+        length += chunks[-1].shape[0]
+        if length >= max_samples:
+            break
+    # Without any detected speech the beginning of the audio is used as is
+    return np.concatenate(chunks)[:max_samples] if chunks else audio[:max_samples]
+
+
+class AudioPreprocessor:
+    """Decodes and resamples uploads to 16 kHz mono float32 arrays on a dedicated thread pool.
+
+    Decoding runs before a request is handed to the inference scheduler, so it
+    overlaps with inference of other requests instead of holding an inference
+    thread. PyAV releases the GIL while decoding and resampling. Callers decode
+    within `scheduler.prepare()`, which bounds the decoded uploads held in memory.
+    """
+
+    def __init__(self, workers: int = DECODE_WORKERS):
+        self.workers = workers
+        self._executor = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="decode")
+            logger.info(f"Audio preprocessing started with {self.workers} threads.")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def decode(self, stream: BinaryIO, model_name: str, max_seconds: float = None) -> np.ndarray:
+        """Decodes the whole upload, or only its first `max_seconds` seconds."""
+        stream.seek(0)
+        loop = asyncio.get_running_loop()
+        # The request context carries the stage timings reported in Server-Timing
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, load_audio, stream, model_name, max_seconds)
+
+
+preprocessor = AudioPreprocessor()
@@ -0,0 +1,260 @@
+import asyncio
+import json
+from collections import deque
+
+import av
+import numpy as np
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.security import HTTPAuthorizationCredentials
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from api_keys import ApiKey
+from constants import (
+    SAMPLING_RATE,
+    REALTIME_MAX_PENDING,
+    REALTIME_MAX_UTTERANCE_S,
+    REALTIME_PARTIAL_INTERVAL_MS,
+    REALTIME_VAD_INTERVAL_MS,
+)
+from logging_config import get_logger
+from model_registry import registry
+from routing import AUTO_MODEL, model_router
+from scheduler import scheduler
+from worker_pool import worker_pool
+from utils import authenticate_user, create_segment_dict, transcribe_audio, validate_parameters
+
+logger = get_logger()
+
+SUPPORTED_ENCODINGS = ("pcm16", "opus")
+
+
+class AudioDecoder:
+    """Converts incoming frames to 16 kHz mono float32 samples."""
+
+    def __init__(self, encoding: str, sample_rate: int):
+        self.encoding = encoding
+        self.sample_rate = sample_rate
+        self._codec = None
+        self._resampler = None
+        # A PCM16 sample split across two frames is completed by the next one
+        self._remainder = b""
+        if encoding == "opus":
+            self._codec = av.CodecContext.create("opus", "r")
+            self._codec.sample_rate = sample_rate
+        if encoding == "opus" or sample_rate != SAMPLING_RATE:
+            self._resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLING_RATE)
+
+    def decode(self, data: bytes) -> np.ndarray:
+        if self._codec is not None:
+            frames = self._codec.decode(av.Packet(data))
+        else:
+            data = self._remainder + data
+            end = len(data) - len(data) % 2
+            self._remainder = data[end:]
+            samples = np.frombuffer(data[:end], dtype=np.int16)
+            if self._resampler is None:
+                return samples.astype(np.float32) / 32768.0
+            frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="mono")
+            frame.sample_rate = self.sample_rate
+            frames = [frame]
+        chunks = [resampled.to_ndarray().reshape(-1) for frame in frames for resampled in self._resampler.resample(frame)]
+        if not chunks:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(chunks).astype(np.float32) / 32768.0
+
+
+def transcribe_utterance(audio: np.ndarray, offset: float, model_name: str, initial_prompt: str, language: str, word_timestamps: bool):
+    if worker_pool.enabled:
+        worker_pool.check_ready()
+        segments, _ = worker_pool.transcribe(model_name, audio, initial_prompt, language, word_timestamps, False, 0)
+        segment_data = [create_segment_dict(segment, word_timestamps) for segment in segments]
+    else:
+        with registry.acquire(model_name) as model:
+            segments, _ = transcribe_audio(audio, model, initial_prompt, language, word_timestamps, False, 0)
+            segment_data = [create_segment_dict(segment, word_timestamps) for segment in segments]
+    for segment in segment_data:
+        segment["start"] = round(segment["start"] + offset, 3)
+        segment["end"] = round(segment["end"] + offset, 3)
+        for word in segment.get("words", ()):
+            word["start"] = round(word["start"] + offset, 3)
+            word["end"] = round(word["end"] + offset, 3)
+    return segment_data
+
+
+class RealtimeSession:
+    """Cuts a live audio stream into utterances with Silero VAD and transcribes them.
+
+    Audio waiting for transcription is bounded: utterances are force-cut after
+    REALTIME_MAX_UTTERANCE_S, at most REALTIME_MAX_PENDING utterances are queued
+    (the oldest is dropped beyond that) and partial results are skipped while a
+    previous transcription is still running.
+    """
+
+    def __init__(self, websocket: WebSocket, decoder: AudioDecoder, model_name: str, language: str, initial_prompt: str, word_timestamps: bool, min_silence_duration_ms: int, api_key: ApiKey):
+        self.websocket = websocket
+        self.decoder = decoder
+        self.model_name = model_name
+        self.language = language
+        self.initial_prompt = initial_prompt
+        self.word_timestamps = word_timestamps
+        self.api_key = api_key
+        self.vad_options = VadOptions(min_silence_duration_ms=min_silence_duration_ms)
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.offset = 0.0
+        self.unchecked = 0
+        self.since_partial = 0
+        self.pending = deque()
+        self.pending_ready = asyncio.Event()
+        self.partial_task = None
+        self.closed = False
+
+    async def run(self):
+        worker = asyncio.create_task(self._transcribe_pending())
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    try:
+                        # Opus decoding and resampling stay off the event loop
+                        samples = await asyncio.to_thread(self.decoder.decode, message["bytes"])
+                    except Exception as e:
+                        logger.warning(f"Could not decode a realtime audio frame: {str(e)}")
+                        await self._send({"type": "error", "error": {"message": f"Could not decode the audio frame: {str(e)}", "type": "invalid_request_error", "param": "", "code": 400}})
+                        continue
+                    await self._append(samples)
+                elif message.get("text") is not None:
+                    try:
+                        control = json.loads(message["text"]).get("type")
+                    except (ValueError, AttributeError):
+                        await self._send({"type": "error", "error": {"message": "Control messages must be JSON objects.", "type": "invalid_request_error", "param": "", "code": 400}})
+                        continue
+                    if control == "commit":
+                        self._cut(self.buffer.shape[0])
+                    elif control == "stop":
+                        self._cut(self.buffer.shape[0])
+                        break
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.closed = True
+            self.pending_ready.set()
+            await worker
+
+    async def _append(self, samples: np.ndarray):
+        self.buffer = np.concatenate((self.buffer, samples))
+        self.unchecked += samples.shape[0]
+        self.since_partial += samples.shape[0]
+        if self.unchecked * 1000 < REALTIME_VAD_INTERVAL_MS * SAMPLING_RATE:
+            return
+        self.unchecked = 0
+
+        audio = self.buffer
+        speech = await asyncio.to_thread(get_speech_timestamps, audio, self.vad_options)
+        if not speech:
+            # Keep only enough trailing audio for the VAD to catch the start of the next word
+            keep = int(self.vad_options.speech_pad_ms * SAMPLING_RATE / 1000)
+            if self.buffer.shape[0] > keep:
+                self._discard(self.buffer.shape[0] - keep)
+            return
+
+        silence_ms = (audio.shape[0] - speech[-1]["end"]) * 1000 / SAMPLING_RATE
+        if silence_ms >= self.vad_options.min_silence_duration_ms:
+            self._cut(speech[-1]["end"])
+        elif audio.shape[0] >= REALTIME_MAX_UTTERANCE_S * SAMPLING_RATE:
+            self._cut(audio.shape[0])
+        elif self.since_partial * 1000 >= REALTIME_PARTIAL_INTERVAL_MS * SAMPLING_RATE and (self.partial_task is None or self.partial_task.done()):
+            self.since_partial = 0
+            self.partial_task = asyncio.create_task(self._send_partial(audio[speech[0]["start"]:], self.offset + speech[0]["start"] / SAMPLING_RATE))
+
+    def _discard(self, samples: int):
+        self.buffer = self.buffer[samples:]
+        self.offset += samples / SAMPLING_RATE
+
+    def _cut(self, samples: int):
+        if samples == 0:
+            return
+        utterance, offset = self.buffer[:samples], self.offset
+        self._discard(samples)
+        self.since_partial = 0
+        if len(self.pending) >= REALTIME_MAX_PENDING:
+            dropped, dropped_offset = self.pending.popleft()
+            logger.warning(f"Realtime session is falling behind, dropped {dropped.shape[0] / SAMPLING_RATE:.2f}s of audio.")
+            asyncio.create_task(self._send({"type": "dropped", "start": round(dropped_offset, 3), "duration": round(dropped.shape[0] / SAMPLING_RATE, 3)}))
+        self.pending.append((utterance, offset))
+        self.pending_ready.set()
+
+    async def _transcribe_pending(self):
+        while True:
+            await self.pending_ready.wait()
+            self.pending_ready.clear()
+            while self.pending:
+                utterance, offset = self.pending.popleft()
+                segments = await self._transcribe(utterance, offset)
+                for segment in segments or ():
+                    await self._send({"type": "segment", "segment": segment})
+            if self.closed:
+                return
+
+    async def _send_partial(self, audio: np.ndarray, offset: float):
+        segments = await self._transcribe(audio, offset, partial=True)
+        if segments:
+            await self._send({
+                "type": "partial",
+                "start": segments[0]["start"],
+                "text": " ".join(segment["text"] for segment in segments).strip(),
+            })
+
+    async def _transcribe(self, audio: np.ndarray, offset: float, partial: bool = False):
+        try:
+            # With model=auto each utterance is routed on its own
+            model = model_router.route(audio.shape[0] / SAMPLING_RATE) if self.model_name == AUTO_MODEL else self.model_name
+            return await scheduler.run(
+                model, transcribe_utterance, audio, offset, model, self.initial_prompt, self.language, self.word_timestamps,
+                # Partials re-transcribe the growing utterance, only the final transcription is charged
+                api_key=self.api_key, cost=0.0 if partial else audio.shape[0] / SAMPLING_RATE,
+            )
+        except HTTPException as e:
+            await self._send({"type": "error", **e.detail})
+        except Exception as e:
+            logger.error(f"An error occurred during realtime transcription: {str(e)}")
+            await self._send({"type": "error", "error": {"message": str(e), "type": type(e).__name__, "param": "", "code": 500}})
+
+    async def _send(self, event: dict):
+        try:
+            await self.websocket.send_json(event)
+        except Exception:
+            # The client is gone, remaining results are discarded
+            self.closed = True
+
+
+async def realtime_transcription(websocket: WebSocket, model: str, language: str, initial_prompt: str, min_silence_duration_ms: int, timestamp_granularities: str, encoding: str, sample_rate: int):
+    await websocket.accept()
+    token = websocket.query_params.get("api_key")
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    try:
+        api_key = authenticate_user(HTTPAuthorizationCredentials(scheme=scheme or "Bearer", credentials=credentials or token or ""))
+        validate_parameters([], language, model, True, min_silence_duration_ms, "verbose_json", timestamp_granularities)
+        if encoding not in SUPPORTED_ENCODINGS:
+            raise HTTPException(status_code=400, detail={
+                "error": {
+                    "message": f"Invalid encoding. Supported encodings are: {', '.join(SUPPORTED_ENCODINGS)}",
+                    "type": "invalid_request_error",
+                    "param": "encoding",
+                    "code": 400
+                }
+            })
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", **e.detail})
+        await websocket.close(code=1008)
+        return
+
+    session = RealtimeSession(websocket, AudioDecoder(encoding, sample_rate), model, language, initial_prompt, timestamp_granularities == "word", min_silence_duration_ms, api_key)
+    await session.run()
+    logger.info("Realtime transcription session closed.")
+    try:
+        await websocket.close()
+    except RuntimeError:
+        # The client already closed the connection
+        pass
@@ -92,4 +92,35 @@ INTERNAL_SERVER_ERROR_RESPONSE = {
             }
         }
     }
-}
\ No newline at end of file
+}
+TOO_MANY_REQUESTS_RESPONSE = {
+    "description": "Too Many Requests",
+    "content": {
+        "application/json": {
+            "example": {
+                "error": {
+                    "message": "Too many pending transcriptions. Please retry later.",
+                    "type": "server_error",
+                    "param": "",
+                    "code": 429
+                }
+            }
+        }
+    }
+}
+
+REQUEST_TOO_LARGE_RESPONSE = {
+    "description": "Request Entity Too Large",
+    "content": {
+        "application/json": {
+            "example": {
+                "error": {
+                    "message": "Request body exceeds the maximum upload size of 1073741824 bytes.",
+                    "type": "invalid_request_error",
+                    "param": "file",
+                    "code": 413
+                }
+            }
+        }
+    }
+}
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import UploadFile
+
+from constants import RESULT_CACHE_SIZE, RESULT_CACHE_PATH, RESULT_CACHE_TTL_S, RESULT_CACHE_MAX_MB
+from logging_config import get_logger
+from serialization import json_dumps, json_loads
+
+logger = get_logger()
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_stream(stream) -> str:
+    digest = hashlib.sha256()
+    while chunk := stream.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def hash_upload(file: UploadFile) -> str:
+    await file.seek(0)
+    # hashlib releases the GIL on large buffers, so hashing runs off the event loop
+    digest = await asyncio.to_thread(hash_stream, file.file)
+    await file.seek(0)
+    return digest
+
+
+class ResultCache:
+    """Transcription results keyed by audio content hash and normalized options.
+
+    Results live in an in-memory LRU tier and, when `path` is set, in an SQLite
+    tier whose entries expire after `ttl` seconds and whose total size is capped
+    at `max_bytes` (least recently used entries are removed first).
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE, path: str = RESULT_CACHE_PATH, ttl: int = RESULT_CACHE_TTL_S, max_bytes: int = RESULT_CACHE_MAX_MB * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._db.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self._db is not None
+
+    @staticmethod
+    def key(audio_hash: str, model: str, language: str, initial_prompt: str, vad_filter: bool, min_silence_duration_ms: int, word_timestamps: bool) -> str:
+        options = {
+            "model": model,
+            "language": language,
+            "initial_prompt": initial_prompt or None,
+            "vad_filter": vad_filter,
+            # The silence duration only matters when the VAD filter is applied
+            "min_silence_duration_ms": min_silence_duration_ms if vad_filter else None,
+            "word_timestamps": word_timestamps,
+        }
+        return f"{audio_hash}:{hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()}"
+
+    def get(self, key: str):
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return result
+            if self._db is not None:
+                now = time.time()
+                row = self._db.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None and (self.ttl <= 0 or now - row[1] <= self.ttl):
+                    self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    result = json_loads(row[0])
+                    self._remember(key, result)
+                    self.disk_hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, key: str, result: dict):
+        with self._lock:
+            self._remember(key, result)
+            if self._db is None:
+                return
+            value = json_dumps(result)
+            now = time.time()
+            self._db.execute("INSERT OR REPLACE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)", (key, value, len(value), now, now))
+            if self.ttl > 0:
+                self._db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+            if self.max_bytes > 0:
+                total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+                for old_key, size in self._db.execute("SELECT key, size FROM results ORDER BY accessed").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._db.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    total -= size
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "max_entries": self.max_entries,
+            }
+            if self._db is not None:
+                stats["disk_entries"], stats["disk_bytes"] = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            return stats
+
+    def _remember(self, key: str, result: dict):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+result_cache = ResultCache()
@@ -0,0 +1,70 @@
+from constants import device, AUTO_MODELS, AUTO_LATENCY_SLO_S
+from logging_config import get_logger
+from metrics import Counter, REAL_TIME_FACTOR
+from scheduler import scheduler
+
+logger = get_logger()
+
+AUTO_MODEL = "auto"
+
+# Real-time factors assumed for a model until it has been measured, on CPU
+PRIOR_RTF = {
+    "tiny": 0.03, "base": 0.05, "small": 0.15, "medium": 0.4, "large": 0.8,
+    "distil-small": 0.08, "distil-medium": 0.2, "distil-large": 0.3,
+}
+# GPUs run every model much faster than real time
+GPU_RTF_SCALE = 0.1
+
+ROUTING_DECISIONS = Counter("routing_decisions", "Models chosen for model=auto requests, by reason.", labelnames=("model", "reason"))
+
+
+def prior_rtf(model: str) -> float:
+    family = model.split(".")[0]
+    for prefix in ("distil-large", "large"):
+        if family.startswith(prefix):
+            family = prefix
+    rtf = PRIOR_RTF.get(family, PRIOR_RTF["large"])
+    return rtf * GPU_RTF_SCALE if device == "cuda" else rtf
+
+
+class ModelRouter:
+    """Picks a model for `model=auto` requests.
+
+    The expected latency of a request is the current queue wait plus its audio
+    duration times the measured real-time factor of each candidate. The largest
+    of `models` (ordered from smallest to largest) expected to finish within
+    `latency_slo` seconds is chosen, so requests move to smaller models as the
+    queue grows and back to larger ones when it drains. When no model fits, the
+    smallest one is used.
+    """
+
+    def __init__(self, models=AUTO_MODELS, latency_slo: float = AUTO_LATENCY_SLO_S):
+        self.models = models
+        self.latency_slo = latency_slo
+
+    def rtf(self, model: str) -> float:
+        measured = REAL_TIME_FACTOR.mean(model=model)
+        return measured if measured is not None else prior_rtf(model)
+
+    def route(self, duration: float) -> str:
+        wait = scheduler.expected_wait()
+        for model in reversed(self.models):
+            if wait + duration * self.rtf(model) <= self.latency_slo:
+                reason = "slo"
+                break
+        else:
+            model, reason = self.models[0], "overload"
+            logger.warning(f"No model meets the {self.latency_slo}s latency objective for {duration:.1f}s of audio, using {model}.")
+        ROUTING_DECISIONS.labels(model=model, reason=reason).inc()
+        return model
+
+    def stats(self) -> dict:
+        return {
+            "models": list(self.models),
+            "latency_slo": self.latency_slo,
+            "expected_wait": round(scheduler.expected_wait(), 3),
+            "rtf": {model: round(self.rtf(model), 4) for model in self.models},
+        }
+
+
+model_router = ModelRouter()
@@ -0,0 +1,307 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+from api_keys import ApiKey, PRIORITIES, api_keys
+from constants import MAX_THREADS, MAX_QUEUE_SIZE, INTERACTIVE_QUEUE_RESERVE, MODEL_CONCURRENCY, SCHEDULER_AGING, DECODE_AHEAD
+from logging_config import get_logger
+from metrics import Gauge
+
+logger = get_logger()
+
+
+class _Waiter:
+    __slots__ = ("model", "exclusive", "api_key", "priority", "cost", "queued", "sequence", "future", "granted")
+
+    def __init__(self, model: str, exclusive: bool, api_key: ApiKey, priority: int, cost: float, sequence: int, future: asyncio.Future):
+        self.model = model
+        self.exclusive = exclusive
+        self.api_key = api_key
+        self.priority = priority
+        self.cost = cost
+        self.queued = time.monotonic()
+        self.sequence = sequence
+        self.future = future
+        self.granted = False
+
+
+class Admission:
+    """Places in the scheduler queue taken by one or more files of a request.
+
+    Each file gives its place back with `release()` once it is transcribed or
+    has failed; `close()`, also called when it is used as a context manager,
+    gives back the places that were not released.
+    """
+
+    __slots__ = ("scheduler", "api_key", "priority", "places")
+
+    def __init__(self, scheduler: "InferenceScheduler", api_key: ApiKey, priority: int, places: int):
+        self.scheduler = scheduler
+        self.api_key = api_key
+        self.priority = priority
+        self.places = places
+
+    def release(self):
+        if self.places > 0:
+            self.places -= 1
+            self.scheduler._leave(self.api_key, 1)
+
+    def close(self):
+        if self.places > 0:
+            self.scheduler._leave(self.api_key, self.places)
+            self.places = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InferenceScheduler:
+    """Runs blocking inference on a long-lived thread pool owned by the app lifespan.
+
+    Work beyond `max_queue_size` outstanding jobs is rejected with 429 and a
+    Retry-After estimate. The last `interactive_reserve` places of the queue are
+    kept for interactive API keys, so batch traffic cannot lock them out, and
+    each API key may hold at most its `max_pending` places. Each model is limited to `model_concurrency`
+    concurrent jobs so CTranslate2's own threads are not oversubscribed. Jobs
+    that are not `exclusive`, such as those decoded by the batching engine on its
+    own threads, only take an inference thread and not a per-model slot.
+
+    Queued jobs start in order of priority class, then of the number of jobs the
+    same API key already has running (fair share), then of expected size in
+    audio seconds (shortest job first). Waiting jobs age by `aging` audio seconds
+    per second so large jobs are not starved. API keys are also held to their
+    concurrency quota and audio-seconds rate limit.
+
+    Files take their place in the queue when they are admitted, before they are
+    decoded. Decoding is gated by `prepare()`, which lets at most `max_prepared`
+    files hold decoded audio until they are transcribed, granted in the same
+    priority and fair-share order.
+    """
+
+    def __init__(self, max_workers: int = MAX_THREADS, max_queue_size: int = MAX_QUEUE_SIZE, interactive_reserve: int = INTERACTIVE_QUEUE_RESERVE, model_concurrency: int = MODEL_CONCURRENCY, aging: float = SCHEDULER_AGING, max_prepared: int = DECODE_AHEAD):
+        self.max_workers = max_workers
+        self.max_prepared = max_prepared
+        self.max_queue_size = max_queue_size
+        self.interactive_reserve = min(interactive_reserve, max_queue_size - 1)
+        self.model_concurrency = model_concurrency
+        self.aging = aging
+        self._executor = None
+        self._waiting = []
+        self._preparing = []
+        self._sequence = itertools.count()
+        self._model_running = {}
+        self._key_running = {}
+        self._key_pending = {}
+        self.pending = 0
+        self.running = 0
+        self.prepared = 0
+        self.rejected = 0
+        self._average_duration = 1.0
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        logger.info(f"Inference scheduler started with {self.max_workers} workers.")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def expected_wait(self) -> float:
+        return self._average_duration * (self.pending - self.running) / self.max_workers
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._average_duration * (self.pending + 1) / self.max_workers))
+
+    def stats(self) -> dict:
+        waiting = {}
+        for waiter in self._waiting:
+            name = waiter.api_key.name if waiter.api_key is not None else ""
+            waiting[name] = waiting.get(name, 0) + 1
+        return {
+            "pending": self.pending,
+            "running": self.running,
+            "prepared": self.prepared,
+            "max_prepared": self.max_prepared,
+            "rejected": self.rejected,
+            "max_queue_size": self.max_queue_size,
+            "interactive_reserve": self.interactive_reserve,
+            "max_workers": self.max_workers,
+            "model_concurrency": self.model_concurrency,
+            "api_keys": {
+                api_key.name: {**api_key.stats(), "pending": self._key_pending.get(api_key.key, 0), "running": self._key_running.get(api_key.key, 0), "waiting": waiting.get(api_key.name, 0)}
+                for api_key in api_keys.values()
+            },
+        }
+
+    def _priority(self, api_key: ApiKey = None, priority: int = None) -> int:
+        if priority is not None:
+            return priority
+        return api_key.priority if api_key is not None else PRIORITIES["standard"]
+
+    def _queue_limit(self, priority: int) -> int:
+        return self.max_queue_size if priority == PRIORITIES["interactive"] else self.max_queue_size - self.interactive_reserve
+
+    def capacity(self, api_key: ApiKey = None, priority: int = None) -> int:
+        """Largest number of transcriptions the key may have pending at once."""
+        capacity = self._queue_limit(self._priority(api_key, priority))
+        if api_key is not None and api_key.max_pending > 0:
+            capacity = min(capacity, api_key.max_pending)
+        return capacity
+
+    def check_capacity(self, api_key: ApiKey = None, count: int = 1, priority: int = None):
+        """Raises 503 or 429 unless `count` more transcriptions of `api_key` can be queued."""
+        if self._executor is None:
+            raise self._unavailable(503, "The inference scheduler is not running.")
+        if self.pending + count > self._queue_limit(self._priority(api_key, priority)):
+            self.rejected += 1
+            logger.warning(f"Inference queue is full ({self.pending} pending), rejecting request.")
+            raise self._unavailable(429, "Too many pending transcriptions. Please retry later.")
+        if api_key is not None:
+            key_pending = self._key_pending.get(api_key.key, 0)
+            if api_key.max_pending > 0 and key_pending + count > api_key.max_pending:
+                self.rejected += 1
+                logger.warning(f"API key {api_key.name} has {key_pending} pending transcriptions, rejecting request.")
+                raise self._unavailable(429, "Too many pending transcriptions for this API key. Please retry later.")
+            api_key.check_rate()
+
+    def admit(self, api_key: ApiKey = None, count: int = 1, priority: int = None) -> Admission:
+        """Takes `count` places in the queue for `api_key`, or raises 503 or 429."""
+        priority = self._priority(api_key, priority)
+        self.check_capacity(api_key, count, priority)
+        key = api_key.key if api_key is not None else None
+        self.pending += count
+        self._key_pending[key] = self._key_pending.get(key, 0) + count
+        return Admission(self, api_key, priority, count)
+
+    def _leave(self, api_key: ApiKey, count: int):
+        key = api_key.key if api_key is not None else None
+        self.pending -= count
+        self._key_pending[key] -= count
+
+    @asynccontextmanager
+    async def prepare(self, admission: Admission):
+        """Waits for one of the `max_prepared` places for decoded audio, held until the block exits."""
+        waiter = _Waiter(None, False, admission.api_key, admission.priority, 0.0, next(self._sequence), asyncio.get_running_loop().create_future())
+        self._preparing.append(waiter)
+        try:
+            self._dispatch_prepare()
+            await waiter.future
+            yield
+        finally:
+            if waiter.granted:
+                self.prepared -= 1
+                self._dispatch_prepare()
+            else:
+                self._preparing.remove(waiter)
+
+    async def run(self, model_name: str, func, *args, admission: Admission = None, api_key: ApiKey = None, cost: float = 0.0, priority: int = None, exclusive: bool = True, **kwargs):
+        """Runs `func` on an inference thread once the job is scheduled.
+
+        The job uses a place of `admission`, or takes its own place for `api_key`
+        and `priority` when no admission is given. `cost` is the expected size of
+        the job in audio seconds; it is withdrawn from the rate limit of the key.
+        """
+        if admission is None:
+            admission = self.admit(api_key, priority=priority)
+            try:
+                return await self.run(model_name, func, *args, admission=admission, cost=cost, exclusive=exclusive, **kwargs)
+            finally:
+                admission.close()
+        api_key = admission.api_key
+        if api_key is not None:
+            api_key.consume(cost)
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(model_name, exclusive, api_key, admission.priority, cost, next(self._sequence), loop.create_future())
+        self._waiting.append(waiter)
+        try:
+            self._dispatch()
+            await waiter.future
+            start = time.perf_counter()
+            try:
+                # The request context carries the stage timings reported in Server-Timing
+                context = contextvars.copy_context()
+                return await loop.run_in_executor(self._executor, functools.partial(context.run, func, *args, **kwargs))
+            finally:
+                self._average_duration = 0.8 * self._average_duration + 0.2 * (time.perf_counter() - start)
+        finally:
+            if waiter.granted:
+                self._release(waiter)
+            else:
+                self._waiting.remove(waiter)
+
+    def _order(self, waiter: _Waiter, now: float):
+        key = waiter.api_key.key if waiter.api_key is not None else None
+        return waiter.priority, self._key_running.get(key, 0), waiter.cost - self.aging * (now - waiter.queued), waiter.sequence
+
+    def _can_start(self, waiter: _Waiter) -> bool:
+        if waiter.exclusive and self._model_running.get(waiter.model, 0) >= self.model_concurrency:
+            return False
+        api_key = waiter.api_key
+        return api_key is None or api_key.max_concurrency <= 0 or self._key_running.get(api_key.key, 0) < api_key.max_concurrency
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.running < self.max_workers:
+            # A waiter whose request was cancelled is removed by its own task
+            candidates = [waiter for waiter in self._waiting if not waiter.future.done() and self._can_start(waiter)]
+            if not candidates:
+                return
+            waiter = min(candidates, key=lambda w: self._order(w, now))
+            self._waiting.remove(waiter)
+            waiter.granted = True
+            self.running += 1
+            if waiter.exclusive:
+                self._model_running[waiter.model] = self._model_running.get(waiter.model, 0) + 1
+            key = waiter.api_key.key if waiter.api_key is not None else None
+            self._key_running[key] = self._key_running.get(key, 0) + 1
+            waiter.future.set_result(None)
+
+    def _dispatch_prepare(self):
+        now = time.monotonic()
+        while self.prepared < self.max_prepared:
+            candidates = [waiter for waiter in self._preparing if not waiter.future.done()]
+            if not candidates:
+                return
+            waiter = min(candidates, key=lambda w: self._order(w, now))
+            self._preparing.remove(waiter)
+            waiter.granted = True
+            self.prepared += 1
+            waiter.future.set_result(None)
+
+    def _release(self, waiter: _Waiter):
+        self.running -= 1
+        if waiter.exclusive:
+            self._model_running[waiter.model] -= 1
+        key = waiter.api_key.key if waiter.api_key is not None else None
+        self._key_running[key] -= 1
+        self._dispatch()
+
+    def _unavailable(self, status_code: int, message: str) -> HTTPException:
+        return HTTPException(
+            status_code=status_code,
+            detail={
+                "error": {
+                    "message": message,
+                    "type": "server_error",
+                    "param": "",
+                    "code": status_code
+                }
+            },
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+
+scheduler = InferenceScheduler()
+Gauge("queue_depth", "Number of admitted transcriptions waiting to be decoded or for an inference thread.", lambda: scheduler.pending - scheduler.running)
+Gauge("running_transcriptions", "Number of transcriptions running on inference threads.", lambda: scheduler.running)
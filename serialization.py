@@ -0,0 +1,88 @@
+import json
+import typing
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Word timestamps from faster-whisper are numpy.float64, which orjson only accepts with this option
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY if orjson is not None else 0
+
+SUBTITLE_MEDIA_TYPES = {"srt": "application/x-subrip", "vtt": "text/vtt"}
+
+
+def json_dumps(content) -> str:
+    if orjson is not None:
+        return orjson.dumps(content, option=ORJSON_OPTIONS).decode()
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed, compact stdlib JSON otherwise."""
+
+    def render(self, content: typing.Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=ORJSON_OPTIONS)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def format_timestamp(seconds: float, separator: str) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+def to_srt(result: dict) -> str:
+    return "".join(
+        f"{index}\n{format_timestamp(segment['start'], ',')} --> {format_timestamp(segment['end'], ',')}\n{segment['text']}\n\n"
+        for index, segment in enumerate(result["segments"], start=1)
+    )
+
+
+def to_vtt(result: dict) -> str:
+    return "WEBVTT\n\n" + "".join(
+        f"{format_timestamp(segment['start'], '.')} --> {format_timestamp(segment['end'], '.')}\n{segment['text']}\n\n"
+        for segment in result["segments"]
+    )
+
+
+def to_columnar(result: dict) -> dict:
+    """Segments and words as parallel arrays instead of one object per item."""
+    segments = result["segments"]
+    columnar = {key: value for key, value in result.items() if key != "segments"}
+    columnar["segments"] = {
+        "start": [segment["start"] for segment in segments],
+        "end": [segment["end"] for segment in segments],
+        "text": [segment["text"] for segment in segments],
+    }
+    if segments and "words" in segments[0]:
+        words = {"start": [], "end": [], "word": [], "segment": []}
+        for index, segment in enumerate(segments):
+            for word in segment["words"]:
+                words["start"].append(word["start"])
+                words["end"].append(word["end"])
+                words["word"].append(word["word"])
+                words["segment"].append(index)
+        columnar["words"] = words
+    return columnar
+
+
+def format_result(result: dict, response_format: str) -> dict:
+    if response_format == "text":
+        return {"text": result["text"]}
+    if response_format == "columnar_json":
+        return to_columnar(result)
+    if response_format == "srt":
+        return {"srt": to_srt(result)}
+    if response_format == "vtt":
+        return {"vtt": to_vtt(result)}
+    return result
@@ -0,0 +1,30 @@
+import time
+
+# Imported first by main.py, so the import of the heavier modules is part of the report
+STARTED = time.perf_counter()
+
+
+class StartupReport:
+    """Durations of the startup phases and whether the configured models are warm."""
+
+    def __init__(self):
+        self.phases = {}
+        self.ready = False
+        self.error = None
+        self._last = STARTED
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round(now - self._last, 3)
+        self._last = now
+
+    def summary(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phases": dict(self.phases),
+            "total": round(self._last - STARTED, 3),
+            "error": self.error,
+        }
+
+
+startup = StartupReport()
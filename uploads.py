@@ -0,0 +1,49 @@
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.formparsers import MultiPartParser
+
+from constants import MAX_UPLOAD_SIZE, UPLOAD_SPOOL_THRESHOLD
+
+# Uploaded files stay in memory up to the threshold and are spooled to disk above it
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_THRESHOLD
+
+UPLOAD_TOO_LARGE_DETAIL = {
+    "error": {
+        "message": f"Request body exceeds the maximum upload size of {MAX_UPLOAD_SIZE} bytes.",
+        "type": "invalid_request_error",
+        "param": "file",
+        "code": 413
+    }
+}
+
+
+class UploadSizeLimitMiddleware:
+    """Rejects request bodies larger than `max_size` while they are being received."""
+
+    def __init__(self, app, max_size: int = MAX_UPLOAD_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_size <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_size:
+            response = JSONResponse(status_code=413, content=UPLOAD_TOO_LARGE_DETAIL)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+            return message
+
+        await self.app(scope, limited_receive, send)
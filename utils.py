@@ -1,15 +1,33 @@
+import asyncio
+import functools
 import os
-import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, List, Union
+import numpy as np
 from fastapi import Depends, HTTPException, status, UploadFile
 from fastapi.security import HTTPAuthorizationCredentials
 from faster_whisper import WhisperModel
-from constants import security, SUPPORTED_EXTENSIONS, SUPPORTED_LANGUAGES, SUPPORTED_MODELS, SUPPORTED_RESPONSE_FORMATS, SUPPORTED_TIMESTAMP_GRANULARITIES
+from constants import SAMPLING_RATE, security, SUPPORTED_EXTENSIONS, SUPPORTED_LANGUAGES, SUPPORTED_MODELS, SUPPORTED_RESPONSE_FORMATS, SUPPORTED_TIMESTAMP_GRANULARITIES
 from logging_config import get_logger
+from metrics import REAL_TIME_FACTOR, timed, timed_iterator
+from model_registry import registry
+from preprocessing import load_audio, preprocessor
+from scheduler import Admission, scheduler
+from batching import batching_engine
+from chunked import long_audio_transcriber
+from worker_pool import worker_pool
+from result_cache import result_cache, hash_upload
+from api_keys import ApiKey, api_keys
+from language_detection import language_detector
+from routing import AUTO_MODEL, model_router
+from serialization import json_dumps
 
 logger = get_logger()
-def authenticate_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    correct_api_key = "dummy_api_key"  # replace with your dummy API key
-    if credentials.scheme != "Bearer" or credentials.credentials != correct_api_key:
+def authenticate_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> ApiKey:
+    api_key = api_keys.get(credentials.credentials) if credentials.scheme == "Bearer" else None
+    if api_key is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail={
@@ -22,54 +40,238 @@ def authenticate_user(credentials: HTTPAuthorizationCredentials = Depends(securi
             },
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return credentials.credentials
+    return api_key
 def get_file_extension(filename: str) -> str:
     _, extension = os.path.splitext(filename)
     return extension[1:].lower()
-async def transcribe_temp_file(file: UploadFile, extension: str, model: WhisperModel, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
-    temp_file = tempfile.NamedTemporaryFile(suffix=extension, delete=False)
-    try:
-        temp_file.write(await file.read())
-        temp_file.close()
-        vad_parameters = dict(min_silence_duration_ms=min_silence_duration_ms) if vad_filter else None
-        segments, info = model.transcribe(temp_file.name, initial_prompt=initial_prompt, language=language, beam_size=5, vad_filter=vad_filter, vad_parameters=vad_parameters, word_timestamps=word_timestamps)
-    finally:
-        os.unlink(temp_file.name)
-    return segments, info
+def transcribe_audio(audio, model: WhisperModel, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+    vad_parameters = dict(min_silence_duration_ms=min_silence_duration_ms) if vad_filter else None
+    return model.transcribe(audio, initial_prompt=initial_prompt, language=language, beam_size=5, vad_filter=vad_filter, vad_parameters=vad_parameters, word_timestamps=word_timestamps)
 
+def create_segment_dict(segment, word_timestamps: bool):
+    segment_dict = {
+        "text": segment.text.strip(),
+        "start": segment.start,
+        "end": segment.end,
+    }
+    if word_timestamps:
+        words_data = []
+        for word in segment.words:
+            words_data.append({
+                "word": word.word.strip(),
+                "start": word.start,
+                "end": word.end
+            })
+        segment_dict["words"] = words_data
+    return segment_dict
 def create_segment_data(segments: list, word_timestamps: bool):
-    segment_data = []
-    for segment in segments:
-        segment_dict = {
-            "text": segment.text.strip(),
-            "start": segment.start,
-            "end": segment.end,
-        }
-        if word_timestamps:
-            words_data = []
-            for word in segment.words:
-                words_data.append({
-                    "word": word.word.strip(),
-                    "start": word.start,
-                    "end": word.end
-                })
-            segment_dict["words"] = words_data
-        segment_data.append(segment_dict)
-    return segment_data
-async def process_file(file: UploadFile, model: WhisperModel, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool,  min_silence_duration_ms: int):
-    extension = get_file_extension(file.filename)
-    segments, info = await transcribe_temp_file(file, extension, model, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms)
+    return [create_segment_dict(segment, word_timestamps) for segment in segments]
+def create_result(filename: str, segments, info, word_timestamps: bool, model_name: str):
     segment_data = create_segment_data(segments, word_timestamps)
     full_text = " ".join([segment["text"] for segment in segment_data]).strip()
     return {
-        "filename": file.filename,
+        "filename": filename,
+        "model": model_name,
         "detected_language": info.language,
         "language_probability": info.language_probability,
         "text": full_text,
         "segments": segment_data
     }
+@contextmanager
+def open_transcription(audio: Union[np.ndarray, BinaryIO], model_name: str, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+    start = time.perf_counter()
+    if not isinstance(audio, np.ndarray):
+        audio = load_audio(audio, model_name)
+    duration = audio.shape[0] / SAMPLING_RATE
+    if worker_pool.enabled:
+        worker_pool.check_ready()
+        yield worker_pool.transcribe(model_name, audio, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms)
+    elif long_audio_transcriber.can_split(duration):
+        yield long_audio_transcriber.transcribe(model_name, audio, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms)
+    elif batching_engine.can_batch(duration, vad_filter):
+        yield batching_engine.transcribe(model_name, audio, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms)
+    else:
+        # Segments are generated lazily, so the model stays checked out while they are consumed
+        with registry.acquire(model_name) as model:
+            with timed("vad", model_name):
+                segments, info = transcribe_audio(audio, model, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms)
+            yield timed_iterator(segments, "generate", model_name), info
+    if duration > 0:
+        REAL_TIME_FACTOR.labels(model=model_name).observe((time.perf_counter() - start) / duration)
+def is_batched(audio: np.ndarray, vad_filter: bool) -> bool:
+    # Mirrors the choice made in open_transcription
+    duration = audio.shape[0] / SAMPLING_RATE
+    return not worker_pool.enabled and not long_audio_transcriber.can_split(duration) and batching_engine.can_batch(duration, vad_filter)
+def transcribe_file(filename: str, audio: Union[np.ndarray, BinaryIO], model_name: str, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+    with open_transcription(audio, model_name, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms) as (segments, info):
+        return create_result(filename, segments, info, word_timestamps, model_name)
+async def cache_key(file: UploadFile, model_name: str, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int, detect_language: bool = False):
+    if not result_cache.enabled:
+        return None
+    audio_hash = await hash_upload(file)
+    if language is None and detect_language:
+        # Results transcribed with the detection model's language are cached apart
+        language = "detect"
+    return result_cache.key(audio_hash, model_name, language, initial_prompt, vad_filter, min_silence_duration_ms, word_timestamps)
+async def detect_file_language(file: UploadFile, audio: np.ndarray, language: str, detect_language: bool, admission: Admission):
+    if language is not None or not detect_language:
+        return language, None
+    # The small detection model picks the language, so the transcription model skips its own detection pass
+    detection = await language_detector.detect_upload(file, audio, admission=admission)
+    return detection["detected_language"], detection["language_probability"]
+async def cached_result(key: str):
+    return await asyncio.to_thread(result_cache.get, key) if key is not None else None
+async def process_file(file: UploadFile, model_name: str, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool,  min_silence_duration_ms: int, detect_language: bool, admission: Admission):
+    try:
+        routed = model_name == AUTO_MODEL
+        # Routing needs the audio duration, so the cache is looked up after decoding
+        key = None if routed else await cache_key(file, model_name, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms, detect_language)
+        cached = await cached_result(key)
+        if cached is not None:
+            return {**cached, "filename": file.filename}
+        # Decoded audio is held in memory until the file is transcribed, so decoding waits for its turn
+        async with scheduler.prepare(admission):
+            # Decoding overlaps with inference of other requests instead of holding an inference thread
+            audio = await preprocessor.decode(file.file, model_name)
+            if routed:
+                model_name = model_router.route(audio.shape[0] / SAMPLING_RATE)
+                key = await cache_key(file, model_name, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms, detect_language)
+                cached = await cached_result(key)
+                if cached is not None:
+                    return {**cached, "filename": file.filename}
+            language, language_probability = await detect_file_language(file, audio, language, detect_language, admission)
+            result = await scheduler.run(
+                model_name, transcribe_file, file.filename, audio, model_name, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms,
+                # Batched chunks must reach the batching engine together instead of waiting for a per-model slot
+                admission=admission, cost=audio.shape[0] / SAMPLING_RATE, exclusive=not is_batched(audio, vad_filter),
+            )
+            if language_probability is not None:
+                result["language_probability"] = language_probability
+            if key is not None:
+                await asyncio.to_thread(result_cache.put, key, result)
+            return result
+    finally:
+        admission.release()
+async def process_files(files: List[UploadFile], *args, api_key: ApiKey = None):
+    """Transcribes the files of one request concurrently, cancelling the others as soon as one fails.
 
-def validate_parameters(files, language, model_size, vad_filter, min_silence_duration_ms, response_format, timestamp_granularities):
+    The queue places of all files are taken at once, so a request that is
+    admitted is not turned away by the queue part way through its files.
+    """
+    with scheduler.admit(api_key, count=len(files)) as admission:
+        tasks = [asyncio.ensure_future(process_file(file, *args, admission)) for file in files]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+def segment_event(filename: str, segment_dict: dict, verbose: bool):
+    return {"type": "segment", "filename": filename, "segment": segment_dict if verbose else {"text": segment_dict["text"]}}
+def done_event(filename: str, result: dict):
+    return {
+        "type": "done",
+        "filename": filename,
+        "model": result.get("model"),
+        "detected_language": result["detected_language"],
+        "language_probability": result["language_probability"],
+        "text": result["text"],
+    }
+def cached_events(filename: str, result: dict, verbose: bool, sse: bool):
+    for segment_dict in result["segments"]:
+        yield format_event(segment_event(filename, segment_dict, verbose), sse)
+    yield format_event(done_event(filename, result), sse)
+def stream_transcription(filename: str, audio: Union[np.ndarray, BinaryIO], model_name: str, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int, verbose: bool, emit, cancelled: threading.Event):
+    with open_transcription(audio, model_name, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms) as (segments, info):
+        segment_data = []
+        for segment in segments:
+            if cancelled.is_set():
+                return None
+            segment_dict = create_segment_dict(segment, word_timestamps)
+            segment_data.append(segment_dict)
+            emit(segment_event(filename, segment_dict, verbose))
+    return {
+        "filename": filename,
+        "model": model_name,
+        "detected_language": info.language,
+        "language_probability": info.language_probability,
+        "text": " ".join([segment["text"] for segment in segment_data]).strip(),
+        "segments": segment_data
+    }
+def format_event(event: dict, sse: bool) -> str:
+    data = json_dumps(event)
+    return f"event: {event['type']}\ndata: {data}\n\n" if sse else f"{data}\n"
+async def stream_files(files: List[UploadFile], model_name: str, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int, verbose: bool, sse: bool, detect_language: bool = False, api_key: ApiKey = None):
+    loop = asyncio.get_running_loop()
+    routed = model_name == AUTO_MODEL
+    for file in files:
+        key = None if routed else await cache_key(file, model_name, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms, detect_language)
+        cached = await cached_result(key)
+        if cached is not None:
+            for event in cached_events(file.filename, cached, verbose, sse):
+                yield event
+            continue
+
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        done = object()
+        try:
+            admission = scheduler.admit(api_key)
+        except HTTPException as e:
+            yield format_event({"type": "error", **e.detail}, sse)
+            return
+        with admission:
+            # Decoded audio is held in memory until the file is transcribed, so decoding waits for its turn
+            async with scheduler.prepare(admission):
+                try:
+                    audio = await preprocessor.decode(file.file, model_name)
+                    file_model = model_name
+                    if routed:
+                        file_model = model_router.route(audio.shape[0] / SAMPLING_RATE)
+                        key = await cache_key(file, file_model, initial_prompt, language, word_timestamps, vad_filter, min_silence_duration_ms, detect_language)
+                        cached = await cached_result(key)
+                    if cached is None:
+                        file_language, language_probability = await detect_file_language(file, audio, language, detect_language, admission)
+                except HTTPException as e:
+                    yield format_event({"type": "error", **e.detail}, sse)
+                    return
+                except Exception as e:
+                    logger.error(f"An error occurred while decoding {file.filename}: {str(e)}")
+                    yield format_event({"type": "error", "error": {"message": str(e), "type": type(e).__name__, "param": "", "code": 500}}, sse)
+                    return
+                if cached is not None:
+                    for event in cached_events(file.filename, cached, verbose, sse):
+                        yield event
+                    continue
+                task = asyncio.ensure_future(scheduler.run(
+                    file_model, stream_transcription, file.filename, audio, file_model, initial_prompt, file_language, word_timestamps, vad_filter, min_silence_duration_ms, verbose,
+                    functools.partial(loop.call_soon_threadsafe, queue.put_nowait), cancelled,
+                    admission=admission, cost=audio.shape[0] / SAMPLING_RATE, exclusive=not is_batched(audio, vad_filter),
+                ))
+                # Runs after every event the worker scheduled on the loop before finishing
+                task.add_done_callback(lambda _: queue.put_nowait(done))
+                try:
+                    while (event := await queue.get()) is not done:
+                        yield format_event(event, sse)
+                    result = task.result()
+                    if language_probability is not None:
+                        result["language_probability"] = language_probability
+                    if key is not None:
+                        await asyncio.to_thread(result_cache.put, key, result)
+                    yield format_event(done_event(file.filename, result), sse)
+                except HTTPException as e:
+                    yield format_event({"type": "error", **e.detail}, sse)
+                    return
+                except Exception as e:
+                    logger.error(f"An error occurred during transcription: {str(e)}")
+                    yield format_event({"type": "error", "error": {"message": str(e), "type": type(e).__name__, "param": "", "code": 500}}, sse)
+                    return
+                finally:
+                    # Stop decoding when the client goes away
+                    cancelled.set()
+    logger.info(f"Streamed transcription completed for {len(files)} file(s).")
+
+def validate_files(files):
     for file in files:
         extension = get_file_extension(file.filename)
         if extension not in SUPPORTED_EXTENSIONS:
@@ -82,6 +284,21 @@ def validate_parameters(files, language, model_size, vad_filter, min_silence_dur
                     "code": 400
                 }
             })
+def validate_file_count(files, api_key: ApiKey = None):
+    # The files of a request are queued together, so more than fit in the queue could never be admitted
+    capacity = scheduler.capacity(api_key)
+    if len(files) > capacity:
+        logger.warning(f"Too many files in one request: {len(files)}")
+        raise HTTPException(status_code=413, detail={
+            "error": {
+                "message": f"Too many files in one request. At most {capacity} files can be transcribed at once.",
+                "type": "invalid_request_error",
+                "param": "file",
+                "code": 413
+            }
+        })
+def validate_parameters(files, language, model_size, vad_filter, min_silence_duration_ms, response_format, timestamp_granularities):
+    validate_files(files)
     if language is not None and language not in SUPPORTED_LANGUAGES:
         logger.warning(f"Invalid language: {language}")
         raise HTTPException(status_code=400, detail={
@@ -0,0 +1,264 @@
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import Future
+from multiprocessing import connection, shared_memory
+
+import numpy as np
+from fastapi import HTTPException
+from faster_whisper import WhisperModel
+from faster_whisper.utils import download_model
+
+from constants import device, compute_type, WORKER_POOL_SIZE, WORKER_POOL_THREADS, WORKER_POOL_MODELS
+from logging_config import get_logger
+
+logger = get_logger()
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # The dispatching process owns the buffer and unlinks it
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+def _worker_main(model_name: str, threads: int, requests, responses):
+    model_key, model = None, None
+    try:
+        if model_name != "*":
+            model_key, model = model_name, WhisperModel(model_name, device=device, compute_type=compute_type, cpu_threads=threads)
+    except Exception as e:
+        responses.send((None, False, f"{type(e).__name__}: {str(e)}"))
+        return
+    # Tells the pool that the assigned model is loaded
+    responses.send((None, True, None))
+    while True:
+        task = requests.get()
+        if task is None:
+            return
+        task_id, shm_name, length, options = task
+        try:
+            if model_key != options["model"]:
+                model_key, model = None, None
+                model = WhisperModel(options["model"], device=device, compute_type=compute_type, cpu_threads=threads)
+                model_key = options["model"]
+            shm = _attach(shm_name)
+            audio = np.ndarray((length,), dtype=np.float32, buffer=shm.buf)
+            try:
+                vad_parameters = dict(min_silence_duration_ms=options["min_silence_duration_ms"]) if options["vad_filter"] else None
+                segments, info = model.transcribe(audio, initial_prompt=options["initial_prompt"], language=options["language"], beam_size=5, vad_filter=options["vad_filter"], vad_parameters=vad_parameters, word_timestamps=options["word_timestamps"])
+                segments = list(segments)
+            finally:
+                # The view must be released before the shared memory can be closed
+                del audio
+                shm.close()
+            responses.send((task_id, True, (segments, info)))
+        except Exception as e:
+            responses.send((task_id, False, f"{type(e).__name__}: {str(e)}"))
+
+
+class _Worker:
+    __slots__ = ("index", "model", "process", "requests", "responses", "tasks", "loaded", "error")
+
+    def __init__(self, index: int, model: str):
+        self.index = index
+        self.model = model
+        self.process = None
+        self.requests = None
+        self.responses = None
+        self.tasks = {}
+        self.loaded = threading.Event()
+        self.error = None
+
+
+class WorkerPool:
+    """Runs inference in separate worker processes; this process only decodes and dispatches.
+
+    Decoded audio is passed to the workers through shared memory as float32
+    buffers. Workers can be dedicated to a model through `models`, where `*` means
+    any model. Each worker answers on its own pipe, so a worker killed while
+    writing cannot block the others. A worker that dies is restarted with new
+    queues and its in-flight tasks are retried once, without affecting tasks on
+    other workers. `start()` returns once every worker has loaded its model; a
+    worker that fails while loading is not restarted.
+    """
+
+    def __init__(self, size: int = WORKER_POOL_SIZE, threads: int = WORKER_POOL_THREADS, models=WORKER_POOL_MODELS):
+        self.size = size
+        self.threads = threads
+        self.models = [models[i] if i < len(models) else "*" for i in range(size)]
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = []
+        self._owners = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = True
+        self.ready = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        if not self.enabled or not self._closed:
+            return
+        # Download the assigned models once so workers load them from the local cache
+        for model in set(self.models) - {"*"}:
+            download_model(model)
+        self._closed = False
+        self._workers = [_Worker(index, model) for index, model in enumerate(self.models)]
+        for worker in self._workers:
+            self._spawn(worker)
+        threading.Thread(target=self._monitor, name="worker-pool-monitor", daemon=True).start()
+        for worker in self._workers:
+            worker.loaded.wait()
+            if worker.error is not None:
+                raise RuntimeError(f"Inference worker {worker.index} failed to load model {worker.model}: {worker.error}")
+        self.ready = True
+        logger.info(f"Worker pool started with {self.size} processes of {self.threads} threads.")
+
+    def check_ready(self):
+        if self.enabled and not self.ready:
+            raise HTTPException(
+                status_code=503,
+                detail={
+                    "error": {
+                        "message": "The inference workers are starting. Please retry later.",
+                        "type": "server_error",
+                        "param": "",
+                        "code": 503
+                    }
+                },
+                headers={"Retry-After": "5"},
+            )
+
+    def shutdown(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.ready = False
+        for worker in self._workers:
+            worker.requests.put(None)
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": [{"model": worker.model, "pid": worker.process.pid, "in_flight": len(worker.tasks)} for worker in self._workers],
+                "restarts": self.restarts,
+            }
+
+    def transcribe(self, model_name: str, audio: np.ndarray, initial_prompt: str, language: str, word_timestamps: bool, vad_filter: bool, min_silence_duration_ms: int):
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, audio.nbytes))
+        try:
+            np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)[:] = audio
+            options = {
+                "model": model_name,
+                "initial_prompt": initial_prompt,
+                "language": language,
+                "word_timestamps": word_timestamps,
+                "vad_filter": vad_filter,
+                "min_silence_duration_ms": min_silence_duration_ms,
+            }
+            for attempt in range(2):
+                try:
+                    return self._dispatch(shm.name, audio.shape[0], options).result()
+                except WorkerCrashed:
+                    if attempt:
+                        raise
+                    logger.warning("Retrying a transcription interrupted by a worker crash.")
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _spawn(self, worker: _Worker):
+        worker.requests = self._context.Queue()
+        worker.responses, responses = self._context.Pipe(duplex=False)
+        worker.loaded.clear()
+        worker.process = self._context.Process(
+            target=_worker_main,
+            args=(worker.model, self.threads, worker.requests, responses),
+            name=f"inference-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        # Only the worker holds the writing end, so the listener sees EOF when it exits
+        responses.close()
+        threading.Thread(target=self._listen, args=(worker, worker.responses), name=f"worker-pool-listener-{worker.index}", daemon=True).start()
+
+    def _dispatch(self, shm_name: str, length: int, options: dict) -> Future:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The worker pool is not running.")
+            workers = [worker for worker in self._workers if worker.error is None]
+            if not workers:
+                raise RuntimeError("No inference worker is running.")
+            candidates = [worker for worker in workers if worker.model == options["model"]]
+            candidates = candidates or [worker for worker in workers if worker.model == "*"] or workers
+            worker = min(candidates, key=lambda w: len(w.tasks))
+            task_id = next(self._ids)
+            future = Future()
+            worker.tasks[task_id] = future
+            self._owners[task_id] = worker
+            worker.requests.put((task_id, shm_name, length, options))
+        return future
+
+    def _listen(self, worker: _Worker, responses):
+        while True:
+            try:
+                task_id, ok, payload = responses.recv()
+            except (EOFError, OSError):
+                responses.close()
+                return
+            if task_id is None:
+                if not ok:
+                    worker.error = payload
+                worker.loaded.set()
+                continue
+            with self._lock:
+                worker = self._owners.pop(task_id, None)
+                future = worker.tasks.pop(task_id, None) if worker is not None else None
+            if future is None:
+                continue
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(payload))
+
+    def _monitor(self):
+        while not self._closed:
+            connection.wait([worker.process.sentinel for worker in self._workers if worker.error is None], timeout=1)
+            for worker in self._workers:
+                if self._closed or worker.error is not None or worker.process.is_alive():
+                    continue
+                with self._lock:
+                    tasks = worker.tasks
+                    worker.tasks = {}
+                    for task_id in tasks:
+                        self._owners.pop(task_id, None)
+                    if worker.loaded.is_set():
+                        logger.error(f"Inference worker {worker.index} exited with code {worker.process.exitcode}, restarting it.")
+                        self.restarts += 1
+                        self._spawn(worker)
+                    else:
+                        # Loading the model would fail again in a new process
+                        worker.error = f"exited with code {worker.process.exitcode} while loading its model"
+                        logger.error(f"Inference worker {worker.index} {worker.error}.")
+                        worker.loaded.set()
+                for future in tasks.values():
+                    future.set_exception(WorkerCrashed(f"Inference worker {worker.index} crashed."))
+
+worker_pool = WorkerPool()